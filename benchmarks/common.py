@@ -0,0 +1,101 @@
+"""
+Helpers shared by the benchmarks: a throwaway application directory, seeding and signed requests
+"""
+import os
+import sys
+import math
+import time
+import hmac
+import base64
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = "benchmark"
+
+
+def start_app(workdir=None):
+    """
+    Import the application from a working directory of its own, where it creates its database
+    :param workdir: Directory to use, a temporary one by default
+    :return: (working directory, twidder package)
+    """
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="twidder-bench-")
+        os.makedirs(os.path.join(workdir, "database"))
+        shutil.copy(os.path.join(ROOT, "database", "database.schema"), os.path.join(workdir, "database"))
+
+    # the application opens its database relative to the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    import twidder
+    # creates the database, before it is seeded
+    twidder.twidder.start()
+    return workdir, twidder
+
+
+def user_email(index):
+    return "user{}@bench.twidder".format(index)
+
+
+def session_token(index):
+    return "bench-token-{}".format(index)
+
+
+def seed(filename, nb_users, nb_posts, nb_sessions, password_hash):
+    """
+    :param filename: Database of the application
+    :param nb_users: Users user<i>@bench.twidder, all with the same password
+    :param nb_posts: Posts, spread evenly over the walls of the users
+    :param nb_sessions: Users, from the first one, given the session token bench-token-<i>
+    :param password_hash: Stored hash of PASSWORD
+    :return:
+    """
+    with sqlite3.connect(filename) as conn:
+        conn.executemany("INSERT INTO users VALUES (?, ?, 'Bench', 'Mark', 'm', 'Linkoping', 'Sweden')",
+                         ((user_email(i), password_hash) for i in range(nb_users)))
+        conn.executemany("INSERT INTO sessions(user, token) VALUES (?, ?)",
+                         ((user_email(i), session_token(i)) for i in range(nb_sessions)))
+        conn.executemany("INSERT INTO posts(to_user, from_user, content) VALUES (?, ?, ?)",
+                         ((user_email(i % nb_users), user_email((i + 1) % nb_users),
+                           "Benchmark post number {}".format(i)) for i in range(nb_posts)))
+
+
+def signed_headers(key, token="", body=""):
+    """
+    Headers checked by security._validate_request, the HMAC covers the timestamp, the session token and the body
+    """
+    timestamp = str(int(time.time()))
+    digest = hmac.new(key, timestamp + token + body, hashlib.sha256).hexdigest()
+    headers = {"X-Request-Hmac": base64.standard_b64encode(digest), "X-Request-Timestamp": timestamp}
+    if token:
+        headers["X-Session-Token"] = token
+    return headers
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    :param latencies: Seconds taken by each request
+    :param errors: Requests answered with an error status
+    :param elapsed: Seconds taken by the whole run
+    :return: JSON friendly summary
+    """
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2)
+    }
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    # nearest rank
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
@@ -0,0 +1,325 @@
+"""
+Load test of the API and of the websocket on a seeded throwaway database, results are written as JSON.
+
+The scenarios run through the Flask test client, one request at a time, then against a gevent WSGIServer
+started in another process with concurrent clients, while websocket clients stay connected:
+    python benchmarks/load.py [--users 1000] [--posts 20000] [--sessions 500] [--requests 1000]
+                              [--login-requests 100] [--concurrency 20] [--websockets 100]
+                              [--mode both] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import socket
+import struct
+import urllib
+import httplib
+import argparse
+import subprocess
+
+import gevent
+import gevent.pool
+
+from common import PASSWORD, start_app, seed, user_email, session_token, signed_headers, summarize
+
+# resolved before start_app moves to the working directory of the benchmark
+SCRIPT = os.path.abspath(__file__)
+
+SECRET_ENVIRONMENT = "TWIDDER_BENCHMARK_SECRET"
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+
+
+class Scenarios(object):
+    def __init__(self, key, nb_users, nb_sessions, nb_requests, nb_login_requests):
+        """
+        Requests of each benchmarked endpoint, the i-th request of a scenario is built by scenario(i)
+        :param key: Secret key of the server, to sign the requests
+        :param nb_users: Seeded users
+        :param nb_sessions: Seeded sessions, users without one are used to log in
+        :param nb_requests: Requests per scenario
+        :param nb_login_requests: Requests of the login scenario, bound by the password hashing
+        :return:
+        """
+        self.key = key
+        self.nb_users = nb_users
+        self.nb_sessions = nb_sessions
+        self.nb_requests = nb_requests
+        self.nb_login_requests = nb_login_requests
+
+    def names(self):
+        names = ["profile", "messages", "post"]
+        if self.nb_users > self.nb_sessions:
+            names.insert(0, "login")
+        return names
+
+    def count(self, name):
+        return self.nb_login_requests if name == "login" else self.nb_requests
+
+    def build(self, name, i):
+        """
+        :return: (method, path, headers, body)
+        """
+        return getattr(self, name)(i)
+
+    def login(self, i):
+        # logging in replaces the session, only users without a seeded session log in
+        email = user_email(self.nb_sessions + i % (self.nb_users - self.nb_sessions))
+        headers = signed_headers(self.key)
+        headers["Authorization"] = "Basic " + base64.b64encode(email + ":" + PASSWORD)
+        return "POST", "/api/login", headers, ""
+
+    def profile(self, i):
+        return "GET", "/api/profile/" + user_email(i % self.nb_users), \
+            signed_headers(self.key, session_token(i % self.nb_sessions)), ""
+
+    def messages(self, i):
+        return "GET", "/api/messages/" + user_email(i % self.nb_users), \
+            signed_headers(self.key, session_token(i % self.nb_sessions)), ""
+
+    def post(self, i):
+        # form bodies are not signed by the client
+        headers = signed_headers(self.key, session_token(i % self.nb_sessions))
+        headers["Content-Type"] = FORM_CONTENT_TYPE
+        return "POST", "/api/messages/" + user_email(i % self.nb_users), headers, \
+            urllib.urlencode({"message": "Load test post {}".format(i)})
+
+
+def run_test_client(app, scenarios):
+    client = app.test_client()
+    results = {}
+    for name in scenarios.names():
+        latencies, errors = [], 0
+        started = time.time()
+        for i in range(scenarios.count(name)):
+            method, path, headers, body = scenarios.build(name, i)
+            start = time.time()
+            response = client.open(path, method=method, headers=headers, data=body)
+            latencies.append(time.time() - start)
+            errors += response.status_code >= 400
+        results[name] = summarize(latencies, errors, time.time() - started)
+    return results
+
+
+def run_server(port, scenarios, concurrency):
+    results = {}
+    for name in scenarios.names():
+        latencies, errors = [], [0]
+        remaining = iter(range(scenarios.count(name)))
+
+        def worker():
+            conn = httplib.HTTPConnection("127.0.0.1", port)
+            for i in remaining:
+                method, path, headers, body = scenarios.build(name, i)
+                start = time.time()
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                    response.read()
+                    errors[0] += response.status >= 400
+                except (httplib.HTTPException, socket.error):
+                    errors[0] += 1
+                    conn.close()
+                    conn = httplib.HTTPConnection("127.0.0.1", port)
+                latencies.append(time.time() - start)
+            conn.close()
+
+        started = time.time()
+        gevent.pool.Pool(concurrency).map(lambda _: worker(), range(concurrency))
+        results[name] = summarize(latencies, errors[0], time.time() - started)
+    return results
+
+
+class WebSocketClient(object):
+    def __init__(self, port, token):
+        """
+        Websocket client of /messages, authenticated with a session token
+        """
+        self.port = port
+        self.token = token
+        self.received = 0
+        self._socket = None
+
+    def connect(self):
+        """
+        :return: Seconds from the connection to the first statistics received
+        """
+        start = time.time()
+        self._socket = socket.create_connection(("127.0.0.1", self.port))
+        self._socket.sendall("GET /messages HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\n"
+                             "Connection: Upgrade\r\nSec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+                             .format(base64.b64encode(os.urandom(16))))
+        handshake = ""
+        while "\r\n\r\n" not in handshake:
+            handshake += self._read(1)
+        if " 101 " not in handshake.split("\r\n", 1)[0]:
+            raise IOError("Websocket handshake refused: " + handshake.split("\r\n", 1)[0])
+
+        self.send({"type": "authenticate", "data": self.token})
+        while self.receive().get("type") != "statistics":
+            pass
+        return time.time() - start
+
+    def send(self, message):
+        data = json.dumps(message)
+        mask = os.urandom(4)
+        if len(data) < 126:
+            header = struct.pack("!BB", 0x81, 0x80 | len(data))
+        else:
+            header = struct.pack("!BBH", 0x81, 0x80 | 126, len(data))
+        masked = "".join(chr(ord(c) ^ ord(mask[i % 4])) for i, c in enumerate(data))
+        self._socket.sendall(header + mask + masked)
+
+    def receive(self):
+        opcode, length = struct.unpack("!BB", self._read(2))
+        length &= 0x7f
+        if length == 126:
+            length = struct.unpack("!H", self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._read(8))[0]
+        data = self._read(length)
+        if opcode & 0x0f == 0x08:
+            raise EOFError("Websocket closed by the server")
+
+        self.received += 1
+        return json.loads(data)
+
+    def listen(self):
+        try:
+            while True:
+                self.receive()
+        except (EOFError, socket.error):
+            pass
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+
+    def _read(self, size):
+        data = ""
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise EOFError("Websocket closed by the server")
+            data += chunk
+        return data
+
+
+def open_websockets(port, nb_clients):
+    clients = [WebSocketClient(port, session_token(i)) for i in range(nb_clients)]
+    latencies, errors = [], [0]
+
+    def connect(client):
+        try:
+            latencies.append(client.connect())
+        except (IOError, EOFError, socket.error):
+            errors[0] += 1
+
+    started = time.time()
+    gevent.joinall([gevent.spawn(connect, client) for client in clients])
+    summary = summarize(latencies, errors[0], time.time() - started)
+    listeners = [gevent.spawn(client.listen) for client in clients if client._socket is not None]
+    return clients, listeners, summary
+
+
+def start_server(workdir, key):
+    with open(os.devnull, "w") as devnull:
+        server = subprocess.Popen([sys.executable, SCRIPT, "--serve", "0"], cwd=workdir,
+                                  env=dict(os.environ, **{SECRET_ENVIRONMENT: key.encode("hex")}),
+                                  stdout=subprocess.PIPE, stderr=devnull)
+    # the server prints the port it listens to once ready
+    port = server.stdout.readline().strip()
+    if not port:
+        server.kill()
+        raise RuntimeError("The server did not start")
+    return server, int(port)
+
+
+def serve(port):
+    """Entry point of the server process, in the working directory of the benchmark"""
+    from gevent.pywsgi import WSGIServer
+    from geventwebsocket.handler import WebSocketHandler
+
+    _, twidder = start_app(os.getcwd())
+    twidder.app.config["SECRET_KEY"] = os.environ[SECRET_ENVIRONMENT].decode("hex")
+
+    server = WSGIServer(("127.0.0.1", port), twidder.app, handler_class=WebSocketHandler, log=None)
+    server.start()
+    print(server.server_port)
+    sys.stdout.flush()
+    # nobody reads the pipe anymore, the logs of the application must not fill it
+    sys.stdout = open(os.devnull, "w")
+    server.serve_forever()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--sessions", type=int, default=500, help="Users logged in, at most --users")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per scenario")
+    parser.add_argument("--login-requests", type=int, default=100, help="Requests of the login scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent clients of the server")
+    parser.add_argument("--websockets", type=int, default=100, help="Websocket clients, at most --sessions")
+    parser.add_argument("--mode", choices=("client", "server", "both"), default="both")
+    parser.add_argument("--output", help="File the JSON results are written to, stdout by default")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        return serve(args.serve)
+
+    args.sessions = max(1, min(args.sessions, args.users))
+    args.websockets = min(args.websockets, args.sessions)
+    root = os.getcwd()
+
+    workdir, twidder = start_app()
+    try:
+        from twidder import app
+        from twidder import twidder as views
+        from werkzeug.security import generate_password_hash
+
+        # one hash for every user, hashing each password would take longer than the benchmark
+        seed(views.CONFIG["database"], args.users, args.posts, args.sessions,
+             generate_password_hash(PASSWORD, views.CONFIG["password_hash_method"]))
+        scenarios = Scenarios(app.config["SECRET_KEY"], args.users, args.sessions, args.requests,
+                              args.login_requests)
+        results = {"config": {key: value for key, value in vars(args).items() if key not in ("serve", "output")}}
+
+        if args.mode in ("client", "both"):
+            results["test_client"] = run_test_client(app, scenarios)
+
+        if args.mode in ("server", "both"):
+            import gevent.monkey
+            gevent.monkey.patch_socket()
+
+            server, port = start_server(workdir, app.config["SECRET_KEY"])
+            try:
+                clients, listeners, results["websocket_connect"] = open_websockets(port, args.websockets)
+                results["server"] = run_server(port, scenarios, args.concurrency)
+                results["websocket_messages_received"] = sum(client.received for client in clients)
+                for client in clients:
+                    client.close()
+                gevent.killall(listeners)
+            finally:
+                server.terminate()
+                server.wait()
+
+        views.db.flush_page_views()
+    finally:
+        os.chdir(root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
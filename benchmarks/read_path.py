@@ -0,0 +1,139 @@
+"""
+Cost of the wall and profile read paths: building the page of posts, encoding it and whole requests,
+the former sqlite3.Row -> Post(**row) -> __dict__ -> indented JSON path against the current one.
+
+Runs against a throwaway database:
+    python benchmarks/read_path.py [--posts 200] [--repeat 300]
+"""
+import gc
+import sys
+import time
+import shutil
+import argparse
+
+from common import start_app, seed, user_email, session_token, signed_headers
+
+EMAIL = user_email(0)
+
+TOKEN = session_token(0)
+
+
+class DictPost(object):
+    """Post as it was built before, every instance carries its own __dict__"""
+
+    def __init__(self, id, to_user, from_user, content, media, date_posted):
+        self.id = id
+        self.date_posted = date_posted
+        self.content = content
+        self.from_user = from_user
+        self.to_user = to_user
+        self.media = media
+
+    def as_dict(self):
+        return self.__dict__
+
+
+def legacy_get_messages(db):
+    """User.get_messages as it was, sqlite3.Row instances turned into DictPost ones"""
+    def get_messages(user, before=None, limit=None):
+        limit = -1 if limit is None else limit
+        conn = db.get_connection()
+        if before:
+            date_posted, post_id = before
+            rows = conn.execute(db.SELECT_MESSAGES_BEFORE, (user.email, date_posted, date_posted, post_id, limit))
+        else:
+            rows = conn.execute(db.SELECT_MESSAGES, (user.email, limit))
+        return [DictPost(**row) for row in rows.fetchall()]
+    return get_messages
+
+
+def measure(function, repeat):
+    """
+    :return: (microseconds per call, container objects allocated and kept by one call)
+    """
+    for _ in range(min(repeat, 10)):
+        function()
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        kept = function()
+        allocated = gc.get_count()[0] - before
+        del kept
+
+        start = time.time()
+        for _ in range(repeat):
+            function()
+        elapsed = time.time() - start
+    finally:
+        gc.enable()
+
+    return elapsed / repeat * 1e6, allocated
+
+
+def report(name, legacy, current):
+    print("{:<28} {:>10.1f} us {:>8} objects  ->  {:>10.1f} us {:>8} objects".format(
+        name, legacy[0], legacy[1], current[0], current[1]))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--posts", type=int, default=200, help="Posts on the wall, also the page size")
+    parser.add_argument("--repeat", type=int, default=300, help="Runs of each measure")
+    args = parser.parse_args(argv)
+
+    workdir, twidder = start_app()
+    try:
+        from twidder import app
+        from twidder import twidder as views
+        from twidder import database_helper as db
+        from flask import json
+
+        seed(views.CONFIG["database"], 1, args.posts, 1, "x")
+        views.CONFIG["max_messages_page_size"] = max(args.posts, views.CONFIG["max_messages_page_size"])
+
+        with app.app_context():
+            db.connect_db(views.CONFIG["database"])
+            conn = db.get_connection()
+
+            def legacy_page():
+                rows = conn.execute(db.SELECT_MESSAGES, (EMAIL, args.posts)).fetchall()
+                return [DictPost(**row).__dict__ for row in rows]
+
+            def current_page():
+                return [views.Post(*row).as_dict() for row in db.select_messages(EMAIL, limit=args.posts)]
+
+            page = current_page()
+            print("{} posts per page, former path -> current path\n".format(len(page)))
+            report("build page", measure(legacy_page, args.repeat), measure(current_page, args.repeat))
+            report("encode page",
+                   measure(lambda: json.dumps(page, indent=2, sort_keys=True), args.repeat),
+                   measure(lambda: json.dumps(page, separators=(",", ":"), sort_keys=False), args.repeat))
+
+        client = app.test_client()
+        key = app.config["SECRET_KEY"]
+
+        def get(url):
+            response = client.get(url, headers=signed_headers(key, TOKEN))
+            assert response.status_code == 200, response.data
+            return response
+
+        # whole requests, the former arm builds the posts and encodes the response the former way
+        current_get_messages = views.User.__dict__["get_messages"]
+        arms = ((legacy_get_messages(db), False), (current_get_messages, True))
+        for url in ("/api/messages?limit={}".format(args.posts), "/api/profile/" + EMAIL):
+            timings = []
+            for get_messages, compact in arms:
+                views.User.get_messages = get_messages
+                views.CONFIG["compact_json"] = compact
+                timings.append(measure(lambda: get(url), args.repeat))
+            report("GET " + url.split("?")[0].replace(EMAIL, "<email>"), *timings)
+        views.User.get_messages = current_get_messages
+        db.flush_page_views()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,110 @@
+import os
+import sys
+import sqlite3
+import argparse
+
+import twidder.migrations as migrations
+import twidder.database_helper as db
+import twidder.assets as assets
+import twidder.security as security
+from twidder import STATIC_FOLDER
+from twidder.twidder import CONFIG
+
+# the schema is found next to this file, wherever the command runs from
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def migrate(args):
+    applied = db.init_database(args.database, os.path.join(ROOT, CONFIG["database_schema"]), args.target)
+    print("Applied migrations: {}".format(applied or "none"))
+    with sqlite3.connect(args.database) as conn:
+        print("Database is at version {}".format(migrations.current_version(conn)))
+
+
+def check_plans(args):
+    with sqlite3.connect(args.database) as conn:
+        try:
+            db.check_query_plans(conn)
+        except db.QueryPlanError as e:
+            print(e)
+            return 1
+        except sqlite3.OperationalError as e:
+            print("{}, the database is at version {} of {}, run `manage.py migrate` first".format(
+                e, migrations.current_version(conn), migrations.latest_version()))
+            return 1
+
+    print("Every query uses an index.")
+    return 0
+
+
+def rebuild_search(args):
+    with sqlite3.connect(args.database) as conn:
+        db.rebuild_search_index(conn)
+        count = conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+    print("Indexed {} posts".format(count))
+    return 0
+
+
+def rebuild_feeds(args):
+    with sqlite3.connect(args.database) as conn:
+        db.rebuild_feeds(conn)
+        count = conn.execute("SELECT COUNT(*) FROM feeds").fetchone()[0]
+    print("Wrote {} feed entries".format(count))
+    return 0
+
+
+def build_static(args):
+    try:
+        manifest = assets.build(STATIC_FOLDER)
+    except assets.AssetBuildError as e:
+        print(e)
+        return 1
+
+    for source, name in sorted(manifest.items()):
+        print("{} -> {}".format(source, name))
+    return 0
+
+
+def profile_header(args):
+    key = args.key or CONFIG["profile_key"]
+    if not key:
+        print("No profiling key, set profile_key in CONFIG or use --key")
+        return 1
+
+    print("{}: {}".format(security.PROFILE_HEADER, security.sign_profile_request(key, args.method, args.path)))
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Twidder maintenance commands")
+    parser.add_argument("--database", default=CONFIG["database"])
+    commands = parser.add_subparsers()
+
+    migrate_parser = commands.add_parser("migrate", help="Apply pending schema migrations")
+    migrate_parser.add_argument("--target", type=int, default=None)
+    migrate_parser.set_defaults(command=migrate)
+
+    check_parser = commands.add_parser("check-plans", help="Fail if a query falls back to a table scan")
+    check_parser.set_defaults(command=check_plans)
+
+    search_parser = commands.add_parser("rebuild-search", help="Index the content of every post again")
+    search_parser.set_defaults(command=rebuild_search)
+
+    feeds_parser = commands.add_parser("rebuild-feeds", help="Fill the feed of every user again")
+    feeds_parser.set_defaults(command=rebuild_feeds)
+
+    static_parser = commands.add_parser("build-static", help="Bundle, minify and precompress the client assets")
+    static_parser.set_defaults(command=build_static)
+
+    profile_parser = commands.add_parser("profile-header", help="Header asking the server to profile a request")
+    profile_parser.add_argument("method")
+    profile_parser.add_argument("path")
+    profile_parser.add_argument("--key", help="Profiling key (profile_key of CONFIG by default)")
+    profile_parser.set_defaults(command=profile_header)
+
+    args = parser.parse_args(argv)
+    return args.command(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,19 +1,336 @@
+"""
+Production: pre-forked gevent workers sharing the listening port, drained gracefully on SIGTERM, restarted
+one by one on SIGHUP:
+    python server.py [--host ""] [--port 5000] [--workers 1] [--connections 1000] [--threadpool 10]
+                     [--graceful-timeout 10]
+Development: one process, restarted when a source file changes, with the interactive debugger:
+    python server.py --dev
+"""
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import select
+import argparse
+
 from gevent.wsgi import WSGIServer
-import werkzeug.debug
-import werkzeug.serving
 from geventwebsocket.handler import WebSocketHandler
 
-import twidder
+# read by the twidder package, every worker must sign with the same key as the client page it served
+SECRET_KEY_ENVIRONMENT = "TWIDDER_SECRET_KEY"
+
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+
+BACKLOG = 1024
+
+# seconds a new worker has to import the application and start listening
+READY_TIMEOUT = 60
+
+# seconds between two checks of the workers, signals wake the launcher up earlier
+TICK = 1
+
+
+class WorkerNotReadyError(Exception):
+    pass
+
+
+def create_socket(address, reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    return sock
+
+
+def supports_reuse_port():
+    if SO_REUSEPORT is None:
+        return False
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_STREAM).setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    except socket.error:
+        return False
+    return True
+
+
+class Launcher(object):
+    def __init__(self, args):
+        """
+        Forks the workers and keeps them running. With SO_REUSEPORT every worker listens on a socket of its own
+        and the kernel balances the connections between them, the launcher only holds the port without listening
+        on it. Without it, the workers share the listening socket of the launcher.
+        :param args: Parsed command line
+        :return:
+        """
+        self.args = args
+        self.reuse_port = supports_reuse_port()
+        self.address = None
+        self.socket = None
+        self.workers = {}
+        self.draining = {}
+        self._stopping = False
+        self._reloading = False
+
+    def run(self):
+        self.socket = create_socket((self.args.host, self.args.port), self.reuse_port)
+        self.address = self.socket.getsockname()
+        if not self.reuse_port:
+            self.socket.listen(BACKLOG)
+
+        # a single key for every worker, present and future
+        os.environ.setdefault(SECRET_KEY_ENVIRONMENT, os.urandom(24).encode("hex"))
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        # only there to cut the sleep of the main loop short
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        try:
+            # one at a time, the first worker applies the pending migrations before the others open the database
+            for _ in range(self.args.workers):
+                self._spawn()
+        except WorkerNotReadyError as e:
+            print("Could not start the workers: {}".format(e))
+            self._terminate(self.workers)
+            self._wait_all()
+            return 1
+
+        print("Listening on {}:{} with {} workers".format(self.address[0], self.address[1], len(self.workers)))
+        while not self._stopping:
+            if self._reloading:
+                self._reloading = False
+                self._restart_workers()
+            self._reap()
+            time.sleep(TICK)
+
+        self._terminate(self.workers)
+        self._wait_all()
+        return 0
+
+    def _stop(self, signum, frame):
+        if self._stopping:
+            # asked twice, no more waiting for the requests in flight
+            self._kill(self.workers)
+            self._kill(self.draining)
+        self._stopping = True
+
+    def _reload(self, signum, frame):
+        self._reloading = True
+
+    def _spawn(self):
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            code = 1
+            try:
+                code = run_worker(self.args, self.address, None if self.reuse_port else self.socket, ready_write)
+            except BaseException as e:
+                print("Worker {} failed: {}".format(os.getpid(), e))
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        os.close(ready_write)
+        self.workers[pid] = time.time()
+        try:
+            self._wait_ready(pid, ready_read)
+        except WorkerNotReadyError:
+            # not replaced when it exits, a worker failing to start would fail again
+            self._terminate({pid: None})
+            raise
+        finally:
+            os.close(ready_read)
+        return pid
+
+    def _wait_ready(self, pid, ready):
+        deadline = time.time() + READY_TIMEOUT
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise WorkerNotReadyError("worker {} did not start in {} seconds".format(pid, READY_TIMEOUT))
+            try:
+                readable, _, _ = select.select([ready], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if readable:
+                if os.read(ready, 1):
+                    return
+                # end of file, the worker exited before listening
+                raise WorkerNotReadyError("worker {} exited while starting".format(pid))
+
+    def _restart_workers(self):
+        """New workers are started before the old ones are drained, the port is served all along"""
+        old = self.workers
+        self.workers = {}
+        try:
+            for _ in range(self.args.workers):
+                self._spawn()
+        except WorkerNotReadyError as e:
+            print("Could not reload, keeping the current workers: {}".format(e))
+            self._terminate(self.workers)
+            self.workers = old
+            return
+
+        self._terminate(old)
+        print("Reloaded, {} workers".format(len(self.workers)))
+
+    def _terminate(self, workers):
+        for pid in list(workers):
+            self.workers.pop(pid, None)
+            self.draining[pid] = time.time() + self.args.graceful_timeout + 5
+            self._signal(pid, signal.SIGTERM)
+
+    def _kill(self, workers):
+        for pid in list(workers):
+            self._signal(pid, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                break
+
+            if self.draining.pop(pid, None) is None and self.workers.pop(pid, None) is not None:
+                print("Worker {} exited unexpectedly ({}), starting another one".format(pid, status))
+                if not self._stopping:
+                    try:
+                        self._spawn()
+                    except WorkerNotReadyError as e:
+                        print("Could not replace the worker: {}".format(e))
+
+        now = time.time()
+        self._kill(pid for pid, deadline in self.draining.items() if deadline < now)
+
+    def _wait_all(self):
+        while self.workers or self.draining:
+            self._reap()
+            time.sleep(0.1)
+
+
+def run_worker(args, address, listener, ready):
+    """
+    Body of a forked worker, the application is imported here so that a reload picks up new code
+    :param args: Parsed command line
+    :param address: Address to listen on
+    :param listener: Listening socket of the launcher, None to listen on a socket of its own with SO_REUSEPORT
+    :param ready: File descriptor written once the worker accepts connections
+    :return: Exit code
+    """
+    # the launcher decides, ^C of the terminal and hangups are sent to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    import gevent
+    import gevent.pool
+    import gevent.event
+
+    gevent.get_hub().threadpool.maxsize = args.threadpool
+
+    import twidder
+    import twidder.database_helper as db
+    from twidder import twidder as views
+
+    # migrations run here, the launcher waits for the first worker before forking the others
+    views.start()
+
+    if args.workers > 1 and views.CONFIG["pubsub"]["backend"] == "local":
+        # a logout or a password change would only reach the cache of the worker that handled it
+        views.session_cache.max_size = 0
+        print("The local pub/sub backend is not shared between workers: sessions are read from the database on "
+              "every request, presence and statistics will be partial, set a sqlite backend in CONFIG")
+
+    if listener is None:
+        listener = create_socket(address, True)
+        listener.listen(BACKLOG)
+    # gevent waits for the socket to be readable, a shared socket is often emptied by another worker first
+    listener.setblocking(0)
+
+    # accepting stops once the pool is full, the other workers take the next connections
+    connections = gevent.pool.Pool(args.connections)
+    server = WSGIServer(listener, twidder.app, handler_class=WebSocketHandler, spawn=connections)
+    server.start()
+
+    stopped = gevent.event.Event()
+
+    def drain():
+        if server.closed:
+            return
+        server.close()
+        # their clients reconnect to another worker instead of holding this one until the timeout
+        views.close_websockets()
+        connections.join(timeout=args.graceful_timeout)
+        connections.kill(block=True, timeout=1)
+        db.flush_page_views()
+        stopped.set()
+
+    gevent.signal(signal.SIGTERM, gevent.spawn, drain)
+
+    os.write(ready, "1")
+    os.close(ready)
+    stopped.wait()
+    return 0
+
+
+def run_development_server(port):
+    import werkzeug.debug
+    import werkzeug.serving
+
+    def run_server():
+        import twidder
+        from twidder import twidder as views
+
+        views.start()
+        app = werkzeug.debug.DebuggedApplication(twidder.app)
+
+        http_server = WSGIServer(('', port), app, handler_class=WebSocketHandler)
+        http_server.serve_forever()
+
+    werkzeug.serving.run_with_reloader(run_server)
+
 
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes")
+    parser.add_argument("--connections", type=int, default=1000,
+                        help="Connections, websockets included, handled at once by a worker")
+    parser.add_argument("--threadpool", type=int, default=10,
+                        help="Native threads of a worker, shared by password hashing, image resizing and DNS lookups")
+    parser.add_argument("--graceful-timeout", type=float, default=10,
+                        help="Seconds a stopping worker waits for its connections to finish")
+    parser.add_argument("--dev", action="store_true", help="Development server with reloader and debugger")
+    args = parser.parse_args(argv)
 
-@werkzeug.serving.run_with_reloader
-def run_server(port=5000, debug=False):
-    app = twidder.app
-    if debug:
-        app = werkzeug.debug.DebuggedApplication(app)
+    if args.dev:
+        return run_development_server(args.port)
 
-    http_server = WSGIServer(('', port), app, handler_class=WebSocketHandler)
-    http_server.serve_forever()
+    args.workers = max(1, args.workers)
+    return Launcher(args).run()
 
 
-run_server(debug=False)
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
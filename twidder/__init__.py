@@ -10,8 +10,12 @@ MEDIA_FOLDER = os.path.join("twidder", "media")
 
 ALLOWED_MEDIA = {"jpg", "png", "mp4", "mp3", "wav"}
 
+# workers started by server.py share the key of their launcher
+SECRET_KEY_ENVIRONMENT = "TWIDDER_SECRET_KEY"
+
 app = Flask(__name__, static_url_path='', static_folder=STATIC_FOLDER)
-app.config["SECRET_KEY"] = os.urandom(24)
+app.config["SECRET_KEY"] = os.environ[SECRET_KEY_ENVIRONMENT].decode("hex") if SECRET_KEY_ENVIRONMENT in os.environ \
+    else os.urandom(24)
 app.config['UPLOAD_FOLDER'] = MEDIA_FOLDER
 app.root_path = os.getcwd()
 
@@ -0,0 +1,192 @@
+import os
+import re
+import gzip
+import shutil
+import hashlib
+import mimetypes
+from StringIO import StringIO
+
+from flask import json, request
+
+from file_response import send_file_cached
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_FOLDER = "dist"
+
+MANIFEST = "manifest.json"
+
+CLIENT_HTML = "client.html"
+
+TEMPLATES_FOLDER = "templates"
+
+URL_PREFIX = "/" + DIST_FOLDER + "/"
+
+# most compact first, each is only written when the library is available
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+SCRIPT_TAG = re.compile(r'[ \t]*<script(?P<attributes>[^>]*)>(?P<content>.*?)</script>[ \t]*\n?', re.S)
+
+STYLESHEET_TAG = re.compile(r'<link[^>]*href="/(?P<path>[^"]+\.css)"[^>]*>')
+
+SRC_ATTRIBUTE = re.compile(r'src="/(?P<path>[^"]+)"')
+
+CSS_URL = re.compile(r'url\(["\']?(?P<url>[^"\')]+)["\']?\)')
+
+
+class AssetBuildError(Exception):
+    pass
+
+
+def build(static_folder):
+    """
+    Bundle, minify and fingerprint the assets loaded by client.html into the dist folder,
+    along with a client.html loading them and a manifest of the written files
+    :param static_folder: Folder of client.html and of the files it loads
+    :return: Manifest, {source: fingerprinted name}
+    """
+    dist = os.path.join(static_folder, DIST_FOLDER)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    os.makedirs(dist)
+
+    with open(os.path.join(static_folder, CLIENT_HTML)) as f:
+        html = f.read()
+
+    manifest = {}
+    html = _bundle_scripts(static_folder, dist, html, manifest)
+    html = STYLESHEET_TAG.sub(
+        lambda tag: tag.group(0).replace("/" + tag.group("path"),
+                                         URL_PREFIX + _build_stylesheet(static_folder, dist, tag.group("path"),
+                                                                        manifest)), html)
+
+    with open(os.path.join(dist, CLIENT_HTML), "w") as f:
+        f.write(html)
+    with open(os.path.join(dist, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def is_built(static_folder):
+    return os.path.exists(os.path.join(static_folder, DIST_FOLDER, MANIFEST))
+
+
+def send_asset(static_folder, filename):
+    """
+    Send a built asset, compressed ahead of time with the best encoding the client accepts
+    :param static_folder: Folder the assets were built in
+    :param filename: Fingerprinted name of the asset
+    :return:
+    """
+    path = os.path.join(static_folder, DIST_FOLDER, os.path.basename(filename))
+    mimetype = mimetypes.guess_type(path)[0]
+    headers = [("Vary", "Accept-Encoding")]
+
+    for encoding, extension in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.exists(path + extension):
+            return send_file_cached(path + extension, filename + "-" + encoding, mimetype,
+                                    headers=headers + [("Content-Encoding", encoding)])
+
+    return send_file_cached(path, filename, mimetype, headers=headers)
+
+
+def _bundle_scripts(static_folder, dist, html, manifest):
+    """
+    Replace each run of external scripts by a single bundle, inline scripts stay between the bundles
+    """
+    bundles = []
+    current = None
+    for tag in SCRIPT_TAG.finditer(html):
+        src = SRC_ATTRIBUTE.search(tag.group("attributes"))
+        if src is None:
+            current = None
+            continue
+        if current is None:
+            current = []
+            bundles.append((tag.start(), current))
+        current.append((tag, src.group("path")))
+
+    for index, (start, scripts) in reversed(list(enumerate(bundles))):
+        sources = [_read(static_folder, path) for _, path in scripts]
+        if index == len(bundles) - 1:
+            # templates travel with the application instead of one request each
+            sources.insert(0, "var TEMPLATE_SOURCES = {};".format(json.dumps(_template_sources(static_folder))))
+
+        content = ";\n".join(rjsmin.jsmin(source) if rjsmin else source for source in sources)
+        name = _write_fingerprinted(dist, "bundle{}.js".format(index), content)
+        manifest["bundle{}.js".format(index)] = name
+        for _, path in scripts:
+            manifest[path] = name
+
+        end = scripts[-1][0].end()
+        html = html[:start] + '\t\t<script src="{}{}" type="text/javascript"></script>\n'.format(URL_PREFIX, name) + \
+            html[end:]
+
+    return html
+
+
+def _build_stylesheet(static_folder, dist, path, manifest):
+    def fingerprint_url(match):
+        url = match.group("url")
+        if url.startswith(("data:", "http:", "https:", "//")):
+            return match.group(0)
+
+        source = os.path.normpath(os.path.join(os.path.dirname(path), url)).lstrip("/")
+        if source not in manifest:
+            with open(os.path.join(static_folder, source), "rb") as f:
+                manifest[source] = _write_fingerprinted(dist, os.path.basename(source), f.read(), compress=False)
+        return 'url("{}")'.format(manifest[source])
+
+    content = CSS_URL.sub(fingerprint_url, _read(static_folder, path))
+    manifest[path] = _write_fingerprinted(dist, os.path.basename(path), rcssmin.cssmin(content) if rcssmin else content)
+    return manifest[path]
+
+
+def _template_sources(static_folder):
+    folder = os.path.join(static_folder, TEMPLATES_FOLDER)
+    return {name[:-len(".hbs")]: _read(folder, name) for name in sorted(os.listdir(folder)) if name.endswith(".hbs")}
+
+
+def _read(folder, path):
+    try:
+        with open(os.path.join(folder, path)) as f:
+            return f.read()
+    except IOError as e:
+        raise AssetBuildError("Could not read {} (are the bower components installed?): {}".format(path, e))
+
+
+def _write_fingerprinted(dist, name, content, compress=True):
+    base, extension = os.path.splitext(name)
+    name = "{}.{}{}".format(base, hashlib.sha256(content).hexdigest()[:16], extension)
+    path = os.path.join(dist, name)
+
+    with open(path, "wb") as f:
+        f.write(content)
+
+    if compress:
+        if brotli is not None:
+            with open(path + ".br", "wb") as f:
+                f.write(brotli.compress(content, quality=11))
+
+        compressed = StringIO()
+        # a fixed mtime keeps the archive identical between builds
+        with gzip.GzipFile(name, "wb", 9, compressed, mtime=0) as f:
+            f.write(content)
+        with open(path + ".gz", "wb") as f:
+            f.write(compressed.getvalue())
+
+    return name
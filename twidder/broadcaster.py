@@ -0,0 +1,142 @@
+import time
+
+import gevent
+import gevent.event
+from geventwebsocket import WebSocketError
+from flask import json
+
+import metrics
+
+DEFAULT_WINDOW = 0.25
+
+DEFAULT_PRESENCE_INTERVAL = 5
+
+PRESENCE_CHANNEL = "presence"
+
+
+class StatisticsBroadcaster(object):
+    def __init__(self, sockets, fetch_statistics, window=DEFAULT_WINDOW, count_connected=None):
+        """
+        Sends statistics to websocket clients from a background greenlet
+        :param sockets: Connected sockets, indexed by user email
+        :param fetch_statistics: Callable returning {email: (nb_posts, nb_views)} for a list of emails
+        :param window: Seconds during which events are coalesced before a broadcast
+        :param count_connected: Callable returning the number of connected users (local sockets by default)
+        :return:
+        """
+        self.sockets = sockets
+        self.window = window
+        self._fetch_statistics = fetch_statistics
+        self._count_connected = count_connected or (lambda: len(self.sockets))
+        self._dirty = set()
+        self._last_sent = {}
+        self._wakeup = gevent.event.Event()
+        self._greenlet = None
+
+    def mark_dirty(self, *emails):
+        """Statistics of these users changed"""
+        self._dirty.update(emails)
+        self._schedule()
+
+    def mark_all_dirty(self):
+        """Statistics shared by every user (number of connected users) changed"""
+        self._dirty.update(self.sockets.keys())
+        self._schedule()
+
+    def request(self, email):
+        """Send statistics to this user even if they did not change"""
+        self._last_sent.pop(email, None)
+        self.mark_dirty(email)
+
+    def forget(self, email):
+        self._last_sent.pop(email, None)
+        self._dirty.discard(email)
+
+    def _schedule(self):
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._run)
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            gevent.sleep(self.window)
+            self._wakeup.clear()
+
+            dirty, self._dirty = self._dirty, set()
+            try:
+                self.broadcast(dirty)
+            except Exception as e:
+                print("Could not broadcast statistics: {}".format(e))
+
+    def broadcast(self, emails):
+        targets = [email for email in emails if email in self.sockets]
+        if not targets:
+            return
+
+        start = time.time()
+        statistics = self._fetch_statistics(targets)
+        nb_connected_users = self._count_connected()
+
+        for email in targets:
+            nb_posts, nb_views = statistics.get(email, (0, 0))
+            statistic = {
+                "nb_connected_users": nb_connected_users,
+                "nb_posts": nb_posts,
+                "nb_views": nb_views
+            }
+            if self._last_sent.get(email) == statistic:
+                continue
+
+            ws = self.sockets.get(email)
+            if ws is None:
+                continue
+            try:
+                ws.send(json.dumps({"type": "statistics", "data": statistic}))
+                self._last_sent[email] = statistic
+            except WebSocketError:
+                self.forget(email)
+
+        metrics.STATISTICS_BROADCAST_DURATION.observe(time.time() - start)
+        metrics.STATISTICS_BROADCAST_SIZE.observe(len(targets))
+
+
+class Presence(object):
+    def __init__(self, pubsub, sockets, on_change, interval=DEFAULT_PRESENCE_INTERVAL):
+        """
+        Number of connected users across every worker sharing the pub/sub
+        :param pubsub: Pub/sub shared by the workers
+        :param sockets: Sockets connected to this worker
+        :param on_change: Called when the total number of connected users changes
+        :param interval: Seconds between two announcements, a worker silent for 3 intervals is forgotten
+        :return:
+        """
+        self.pubsub = pubsub
+        self.sockets = sockets
+        self.interval = interval
+        self._on_change = on_change
+        self._workers = {}
+        self._heartbeat = None
+        pubsub.subscribe(PRESENCE_CHANNEL, self._on_presence)
+
+    def count(self):
+        expired = time.time() - 3 * self.interval
+        remote = sum(count for worker, (count, seen) in self._workers.items()
+                     if worker != self.pubsub.origin and seen > expired)
+        return len(self.sockets) + remote
+
+    def announce(self):
+        if self._heartbeat is None or self._heartbeat.dead:
+            self._heartbeat = gevent.spawn(self._run)
+        self.pubsub.publish(PRESENCE_CHANNEL, {"worker": self.pubsub.origin, "count": len(self.sockets)})
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.pubsub.publish(PRESENCE_CHANNEL, {"worker": self.pubsub.origin, "count": len(self.sockets)})
+
+    def _on_presence(self, message):
+        previous = self._workers.get(message["worker"], (0, 0))[0]
+        self._workers[message["worker"]] = (message["count"], time.time())
+        if previous != message["count"]:
+            self._on_change()
@@ -0,0 +1,80 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    def __init__(self, max_size, ttl, clock=time.time):
+        """
+        Least recently used cache whose entries also expire after a delay
+        :param max_size: Maximum number of entries
+        :param ttl: Seconds an entry stays valid
+        :param clock: Time source
+        :return:
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._tags = {}
+
+    def get(self, key, default=None):
+        try:
+            value, expires, tag = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires < self._clock():
+            self._untag(key, tag)
+            self.misses += 1
+            return default
+
+        self._entries[key] = (value, expires, tag)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, tag=None):
+        """
+        :param key: Entry key
+        :param value: Entry value
+        :param tag: Optional tag, every entry sharing a tag can be removed with invalidate_tag
+        :return:
+        """
+        self.invalidate(key)
+        self._entries[key] = (value, self._clock() + self.ttl, tag)
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.max_size:
+            oldest, (_, _, oldest_tag) = self._entries.popitem(last=False)
+            self._untag(oldest, oldest_tag)
+
+    def invalidate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._untag(key, entry[2])
+
+    def invalidate_tag(self, tag):
+        for key in self._tags.pop(tag, ()):
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _untag(self, key, tag):
+        keys = self._tags.get(tag)
+        if keys is None:
+            return
+
+        keys.discard(key)
+        if not keys:
+            del self._tags[tag]
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,10 +1,43 @@
+import re
+import time
+import atexit
 import sqlite3
+from collections import Counter
+
+import gevent
+import gevent.event
+import gevent.queue
 from flask import g
 
+import metrics
+import migrations
+
 SCHEMA_FILE = "database.schema"
 
+POOL_SIZE = 8
+
+POOL_TIMEOUT = 10
+
+WRITE_BATCH_LATENCY = 0.005
+
+WRITE_BATCH_SIZE = 256
+
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA busy_timeout = 5000"
+)
+
 SELECT_USER = (
-    "SELECT * FROM users WHERE email = ?"
+    "SELECT email, password, first_name, family_name, gender, city, country FROM users WHERE email = ?"
+)
+
+USER_INFO_FIELDS = ("email", "first_name", "family_name", "gender", "city", "country")
+
+SELECT_USER_INFO = (
+    "SELECT " + ", ".join(USER_INFO_FIELDS) + " FROM users WHERE email = ?"
 )
 
 UPDATE_USER = (
@@ -21,7 +54,7 @@ INSERT_USER = (
     "  (?, ?, ?, ?, ?, ?, ?)"
 )
 
-SELECT_SESSION = "SELECT * FROM sessions WHERE token = ?"
+SELECT_SESSION = "SELECT user FROM sessions WHERE token = ?"
 
 UPDATE_SESSION = "UPDATE sessions SET token = ? WHERE user = ?"
 
@@ -29,19 +62,182 @@ INSERT_SESSION = "INSERT OR IGNORE INTO sessions(user, token) VALUES (?, ?)"
 
 DELETE_SESSION = "DELETE FROM sessions WHERE token = ?"
 
-SELECT_MESSAGES = "SELECT * FROM posts WHERE to_user = ? ORDER BY date_posted DESC"
+MESSAGES_PAGE_SIZE = 50
+
+# rows read at once, with a connection of the pool, by a streamed wall
+STREAM_BATCH_SIZE = 100
+
+SELECT_MESSAGES = (
+    "SELECT rowid AS id, to_user, from_user, content, media, date_posted FROM posts "
+    "WHERE to_user = ? "
+    "ORDER BY date_posted DESC, rowid DESC LIMIT ?"
+)
+
+SELECT_MESSAGES_BEFORE = (
+    "SELECT rowid AS id, to_user, from_user, content, media, date_posted FROM posts "
+    "WHERE to_user = ? AND date_posted <= ? AND (date_posted < ? OR rowid < ?) "
+    "ORDER BY date_posted DESC, rowid DESC LIMIT ?"
+)
+
+SELECT_NUMBER_OF_MESSAGES = "SELECT number_posts FROM post_counts WHERE user = ?"
+
+# entries kept in a feed, as many as the migration and rebuild_feeds fill in
+FEED_LENGTH = migrations.FEED_LENGTH
+
+# seconds between two trims of the feeds that received posts
+FEED_TRIM_INTERVAL = 5
+
+INSERT_CONTACT = "INSERT OR IGNORE INTO contacts(user, contact) VALUES (?, ?)"
+
+SELECT_CONTACTS = "SELECT contact FROM contacts WHERE user = ?"
+
+INSERT_FEED_ENTRY = (
+    "INSERT OR IGNORE INTO feeds(user, date_posted, post_id) "
+    "SELECT ?, date_posted, rowid FROM posts WHERE rowid = ?"
+)
+
+SELECT_FEED = (
+    "SELECT posts.rowid AS id, to_user, from_user, content, media, posts.date_posted FROM feeds "
+    "  JOIN posts ON posts.rowid = feeds.post_id "
+    "WHERE feeds.user = ? "
+    "ORDER BY feeds.date_posted DESC, feeds.post_id DESC LIMIT ?"
+)
+
+SELECT_FEED_BEFORE = (
+    "SELECT posts.rowid AS id, to_user, from_user, content, media, posts.date_posted FROM feeds "
+    "  JOIN posts ON posts.rowid = feeds.post_id "
+    "WHERE feeds.user = ? AND feeds.date_posted <= ? AND (feeds.date_posted < ? OR feeds.post_id < ?) "
+    "ORDER BY feeds.date_posted DESC, feeds.post_id DESC LIMIT ?"
+)
+
+# first entry past the length of a feed
+SELECT_FEED_BOUNDARY = (
+    "SELECT date_posted, post_id FROM feeds WHERE user = ? "
+    "ORDER BY date_posted DESC, post_id DESC LIMIT 1 OFFSET ?"
+)
+
+DELETE_FEED_ENTRIES = "DELETE FROM feeds WHERE user = ? AND date_posted <= ? AND (date_posted < ? OR post_id <= ?)"
+
+DELETE_FEEDS = "DELETE FROM feeds"
+
+SEARCH_PAGE_SIZE = 20
+
+# words of context around the matches in a snippet
+SEARCH_SNIPPET_TOKENS = 12
+
+# the content of posts is escaped HTML, so is a snippet
+SEARCH_SNIPPET_MARKUP = ("<mark>", "</mark>", "...")
+
+# best matches first, rank is the bm25 score of FTS5, lower is better
+SEARCH_MESSAGES = (
+    "SELECT posts.rowid AS id, to_user, from_user, posts.content, media, date_posted, "
+    "  snippet(posts_search, 0, ?, ?, ?, ?) AS snippet, posts_search.rank AS rank "
+    "FROM posts_search JOIN posts ON posts.rowid = posts_search.rowid "
+    "WHERE posts_search MATCH ? "
+    "ORDER BY posts_search.rank, posts_search.rowid LIMIT ?"
+)
+
+SEARCH_MESSAGES_AFTER = (
+    "SELECT posts.rowid AS id, to_user, from_user, posts.content, media, date_posted, "
+    "  snippet(posts_search, 0, ?, ?, ?, ?) AS snippet, posts_search.rank AS rank "
+    "FROM posts_search JOIN posts ON posts.rowid = posts_search.rowid "
+    "WHERE posts_search MATCH ? "
+    "  AND (posts_search.rank > ? OR (posts_search.rank = ? AND posts_search.rowid > ?)) "
+    "ORDER BY posts_search.rank, posts_search.rowid LIMIT ?"
+)
+
+REBUILD_SEARCH_INDEX = "INSERT INTO posts_search(posts_search) VALUES ('rebuild')"
+
+OPTIMIZE_SEARCH_INDEX = "INSERT INTO posts_search(posts_search) VALUES ('optimize')"
+
+SELECT_STATISTICS = (
+    "SELECT users.email, "
+    "  COALESCE(post_counts.number_posts, 0) AS number_posts, "
+    "  COALESCE(page_views.number_views, 0) AS number_views "
+    "FROM users "
+    "  LEFT JOIN post_counts ON post_counts.user = users.email "
+    "  LEFT JOIN page_views ON page_views.user = users.email "
+    "WHERE users.email IN ({})"
+)
+
+STATISTICS_BATCH_SIZE = 100
 
 INSERT_MESSAGE = "INSERT INTO posts(to_user, from_user, content, media) VALUES (?, ?, ?, ?)"
 
-SELECT_PAGE_VIEWS = "SELECT * FROM page_views WHERE user = ?"
+SELECT_PAGE_VIEWS = "SELECT number_views FROM page_views WHERE user = ?"
 
 INSERT_PAGE_VIEWS = "INSERT OR IGNORE INTO page_views(user) VALUES (?)"
 
-UPDATE_PAGE_VIEWS = "UPDATE page_views SET number_views = number_views+1 WHERE user = ?"
+UPDATE_PAGE_VIEWS = "UPDATE page_views SET number_views = number_views + ? WHERE user = ?"
+
+PAGE_VIEWS_FLUSH_INTERVAL = 0.5
+
+PAGE_VIEWS_FLUSH_SIZE = 500
+
+SELECT_MEDIA = "SELECT name, user, content_hash FROM media WHERE name = ?"
+
+INSERT_MEDIA = "INSERT INTO media (user, name, content_hash) VALUES (?, ?, ?)"
+
+SELECT_MEDIA_VARIANT = "SELECT variant_hash, mimetype FROM media_variants WHERE content_hash = ? AND size = ?"
+
+SELECT_MEDIA_VARIANT_SIZES = "SELECT size FROM media_variants WHERE content_hash = ?"
+
+INSERT_MEDIA_VARIANT = ("INSERT OR REPLACE INTO media_variants (content_hash, size, variant_hash, mimetype) "
+                        "VALUES (?, ?, ?, ?)")
+
+
+def _query_constants():
+    return {name: value for name, value in globals().items()
+            if name.isupper() and isinstance(value, str) and
+            value.split(" ", 1)[0] in ("SELECT", "INSERT", "UPDATE", "DELETE")}
+
+
+_query_names = {}
+
+
+def _query_name(sql):
+    """
+    :return: Name of the constant a statement comes from, its first keyword if it is not one of them
+    """
+    name = _query_names.get(sql)
+    if name is None:
+        constants = _query_constants()
+        names = {query: constant for constant, query in constants.items()}
+        # templates such as SELECT_STATISTICS are formatted before they run
+        templates = [(query.split("{", 1)[0], constant) for constant, query in constants.items() if "{" in query]
+        name = names.get(sql) or next((constant for prefix, constant in templates if sql.startswith(prefix)),
+                                      (sql.split(None, 1) or ["EMPTY"])[0].upper())
+        _query_names[sql] = name
+    return name
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return _timed(super(InstrumentedCursor, self).execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return _timed(super(InstrumentedCursor, self).executemany, sql, parameters)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection timing each of its statements, only used when metrics are enabled"""
 
-SELECT_MEDIA = "SELECT * FROM media WHERE name = ?"
+    def cursor(self, factory=InstrumentedCursor):
+        # Connection.execute goes through this method as well
+        return super(InstrumentedConnection, self).cursor(factory)
+
+
+def _timed(execute, sql, parameters):
+    start = time.time()
+    try:
+        return execute(sql, parameters)
+    except sqlite3.OperationalError as e:
+        if "locked" in str(e):
+            metrics.SQLITE_LOCKED.inc(_query_name(sql))
+        raise
+    finally:
+        metrics.SQLITE_QUERY_DURATION.observe(time.time() - start, _query_name(sql))
 
-INSERT_MEDIA = "INSERT INTO media (user, name) VALUES (?, ?)"
 
 class UserDoesNotExist(Exception):
     def __init__(self): pass
@@ -63,28 +259,305 @@ class CouldNotFindMessages(Exception):
     def __init__(self): pass
 
 
+class CouldNotSearchMessages(Exception):
+    pass
+
+
+def create_connection(filename):
+    conn = sqlite3.connect(filename, check_same_thread=False,
+                           cached_statements=2 * len(_query_constants()),
+                           factory=InstrumentedConnection if metrics.enabled else sqlite3.Connection)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+
+    return conn
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, filename, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        """
+        Bounded pool of SQLite connections, a greenlet checking out twice gets the same connection back
+        :param filename: Database file
+        :param size: Maximum number of opened connections
+        :param timeout: Seconds to wait for a free connection before giving up
+        :return:
+        """
+        self.filename = filename
+        self.size = size
+        self.timeout = timeout
+        self._idle = gevent.queue.LifoQueue()
+        self._opened = 0
+        self._owners = {}
+
+    def checkout(self):
+        owner = gevent.getcurrent()
+        if owner in self._owners:
+            conn, depth = self._owners[owner]
+            self._owners[owner] = (conn, depth + 1)
+            return conn
+
+        if self._idle.empty() and self._opened < self.size:
+            self._opened += 1
+            try:
+                conn = create_connection(self.filename)
+            except sqlite3.Error:
+                self._opened -= 1
+                raise
+        else:
+            start = time.time()
+            try:
+                conn = self._idle.get(timeout=self.timeout)
+            except gevent.queue.Empty:
+                raise PoolTimeoutError()
+            finally:
+                metrics.POOL_WAIT.observe(time.time() - start)
+
+        self._owners[owner] = (conn, 1)
+        return conn
+
+    def checkin(self, conn):
+        owner = self._find_owner(conn)
+        held, depth = self._owners.get(owner, (conn, 1))
+        if depth > 1:
+            self._owners[owner] = (held, depth - 1)
+            return
+
+        self._owners.pop(owner, None)
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        self._idle.put(conn)
+
+    def _find_owner(self, conn):
+        owner = gevent.getcurrent()
+        if self._owners.get(owner, (None, 0))[0] is conn:
+            return owner
+
+        for other, (held, _) in self._owners.items():
+            if held is conn:
+                return other
+        return owner
+
+    def _discard(self, conn):
+        self._opened -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        while not self._idle.empty():
+            self._discard(self._idle.get())
+
+
+_pools = {}
+
+
+def get_pool(filename, size=POOL_SIZE):
+    if filename not in _pools:
+        _pools[filename] = ConnectionPool(filename, size)
+
+    return _pools[filename]
+
+
+class GroupCommitWriter(object):
+    def __init__(self, filename, max_latency=WRITE_BATCH_LATENCY, max_batch=WRITE_BATCH_SIZE):
+        """
+        Owns the write connection of a database and commits queued mutations together
+        :param filename: Database file
+        :param max_latency: Seconds the first mutation of a batch waits for others to join it, a mutation alone in
+        the queue is committed at once
+        :param max_batch: Maximum number of mutations in one transaction
+        :return:
+        """
+        self.filename = filename
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self._queue = gevent.queue.Queue()
+        self._conn = None
+        self._greenlet = None
+
+    def submit(self, mutation):
+        """
+        Run a mutation in the next group commit and wait for it
+        :param mutation: Callable receiving the write connection, its own errors are isolated in a savepoint
+        :return: Value returned by the mutation, raises its exception if it failed
+        """
+        result = gevent.event.AsyncResult()
+        self._queue.put((mutation, result))
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._run)
+
+        return result.get()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # waiting only pays off under load, when other writes are already queued behind the first one
+            deadline = time.time() + (self.max_latency if not self._queue.empty() else 0)
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except gevent.queue.Empty:
+                    break
+
+            self._commit(batch)
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = create_connection(self.filename)
+            # transactions and savepoints are handled by hand, not by the sqlite3 module
+            self._conn.isolation_level = None
+
+        return self._conn
+
+    def _commit(self, batch):
+        outcomes = []
+        start = time.time()
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            metrics.SQLITE_LOCK_WAIT.observe(time.time() - start)
+            for mutation, result in batch:
+                conn.execute("SAVEPOINT mutation")
+                try:
+                    outcomes.append((result, mutation(conn), None))
+                except Exception as e:
+                    # only the caller of a failing mutation sees its error, the rest of the batch is committed
+                    conn.execute("ROLLBACK TO mutation")
+                    outcomes.append((result, None, e))
+                conn.execute("RELEASE mutation")
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            self._rollback()
+            outcomes = [(result, None, e) for _, result in batch]
+        except BaseException as e:
+            self._rollback()
+            for _, result in batch:
+                result.set_exception(e)
+            raise
+
+        metrics.SQLITE_COMMIT_DURATION.observe(time.time() - start)
+        metrics.SQLITE_COMMIT_SIZE.observe(len(batch))
+        for result, value, error in outcomes:
+            if error is None:
+                result.set(value)
+            else:
+                result.set_exception(error)
+
+    def _rollback(self):
+        try:
+            self._conn.execute("ROLLBACK")
+        except (sqlite3.Error, AttributeError):
+            pass
+
+
+_writers = {}
+
+
+def get_writer(filename, max_latency=WRITE_BATCH_LATENCY, max_batch=WRITE_BATCH_SIZE):
+    if filename not in _writers:
+        _writers[filename] = GroupCommitWriter(filename, max_latency, max_batch)
+
+    return _writers[filename]
+
+
+def _write(mutation):
+    return get_writer(g.db_pool.filename).submit(mutation)
+
+
 def connect_db(filename):
-    g.db = sqlite3.connect(filename)
-    g.db.row_factory = sqlite3.Row
+    """
+    Bind the database to the current context, a connection is only checked out of the pool by the first query
+    :param filename: Database file
+    :return:
+    """
+    g.db_pool = get_pool(filename)
+    g.db = None
+
+
+def get_connection():
+    conn = g.get("db")
+    if conn is None:
+        conn = g.db = g.db_pool.checkout()
+    return conn
 
 
 def close_db():
+    conn = g.get("db")
+    if conn is None:
+        return
+
+    g.db = None
     try:
-        g.db.close()
+        g.db_pool.checkin(conn)
     except Exception as e:
         print(e)
 
 
-def init_database(db_filename, schema_filename):
+def init_database(db_filename, schema_filename, target=None):
+    """
+    Create the tables of a new database and apply the pending migrations
+    :param db_filename: Database file
+    :param schema_filename: Initial schema
+    :param target: Version to stop at (latest by default)
+    :return: Versions that were applied
+    """
     with open(schema_filename, "r") as schema:
         with sqlite3.connect(db_filename) as db:
-            query = schema.read()
-            db.executescript(query)
-            db.commit()
+            if migrations.current_version(db) == 0:
+                query = schema.read()
+                db.executescript(query)
+                db.commit()
+            return migrations.migrate(db, target)
+
+
+class QueryPlanError(Exception):
+    def __init__(self, scans):
+        super(QueryPlanError, self).__init__(
+            "Queries scanning a table: " + ", ".join("{} ({})".format(*s) for s in sorted(scans)))
+        self.scans = scans
+
+
+def check_query_plans(conn):
+    """
+    Runs EXPLAIN QUERY PLAN on every query of this module
+    :param conn: Connection to a migrated database
+    :return: Raises QueryPlanError if a query falls back to a scan
+    """
+    scans = []
+    for name, query in _query_constants().items():
+        query = query.format("?")
+        parameters = (None,) * query.count("?")
+        for row in conn.execute("EXPLAIN QUERY PLAN " + query, parameters).fetchall():
+            detail = row[-1]
+            if detail.startswith("SCAN") and not _is_full_text_lookup(detail):
+                scans.append((name, detail))
+
+    if scans:
+        raise QueryPlanError(scans)
+
+
+def _is_full_text_lookup(detail):
+    # a MATCH on an FTS5 table is planned as a scan of the virtual table, with an M in the index string
+    # (an odd index number in older versions of SQLite)
+    match = re.match(r"SCAN (?:TABLE )?\w+ VIRTUAL TABLE INDEX (\d+):(\S*)", detail)
+    return bool(match) and ("M" in match.group(2) or int(match.group(1)) & 1 == 1)
 
 
 def select_user(email):
-    conn = g.db
+    conn = get_connection()
     try:
         user = conn.execute(SELECT_USER, (email,)).fetchone()
         if not user:
@@ -95,15 +568,34 @@ def select_user(email):
         raise UserDoesNotExist()
 
 
+def select_user_info(email):
+    """
+    Public profile of a user, without building the whole user
+    :return: Dict of the profile fields
+    """
+    conn = get_connection()
+    try:
+        query = conn.cursor()
+        query.row_factory = None
+        user = query.execute(SELECT_USER_INFO, (email,)).fetchone()
+        if not user:
+            raise UserDoesNotExist()
+
+        return dict(zip(USER_INFO_FIELDS, user))
+    except sqlite3.Error:
+        raise UserDoesNotExist()
+
+
 def persist_user(user_data):
     if not _is_user_valid(user_data):
         return False
 
-    conn = g.db
-    try:
+    def mutation(conn):
         conn.execute(UPDATE_USER, (user_data["password"], user_data["first_name"], user_data["family_name"], user_data["gender"], user_data["city"], user_data["country"], user_data["email"],))
         conn.execute(INSERT_USER, (user_data["email"], user_data["password"], user_data["first_name"], user_data["family_name"], user_data["gender"], user_data["city"], user_data["country"],))
-        conn.commit()
+
+    try:
+        _write(mutation)
     except sqlite3.Error:
         return False
 
@@ -122,17 +614,18 @@ def _is_user_valid(user_data):
 
 
 def persist_session(email, token):
-    conn = g.db
-    try:
+    def mutation(conn):
         conn.execute(UPDATE_SESSION, (token, email))
         conn.execute(INSERT_SESSION, (email, token))
-        conn.commit()
+
+    try:
+        _write(mutation)
     except sqlite3.Error:
         raise CouldNotCreateSessionError()
 
 
 def select_session(token):
-    conn = g.db
+    conn = get_connection()
     try:
         session = conn.execute(SELECT_SESSION, (token,)).fetchone()
         if not session:
@@ -144,57 +637,355 @@ def select_session(token):
 
 
 def delete_session(token):
-    conn = g.db
     try:
-        conn.execute(DELETE_SESSION, (token,))
-        conn.commit()
+        _write(lambda conn: conn.execute(DELETE_SESSION, (token,)))
     except sqlite3.Error:
         raise CouldNotDeleteSession()
 
 
-def select_messages(email):
-    conn = g.db
+def select_messages(email, before=None, limit=MESSAGES_PAGE_SIZE):
+    """
+    Messages posted on a wall, newest first
+    :param email: Owner of the wall
+    :param before: (date_posted, id) of the last message already seen, None for the first page
+    :param limit: Maximum number of messages, None for all of them
+    :return: (id, to_user, from_user, content, media, date_posted) tuples
+    """
+    conn = get_connection()
+    limit = -1 if limit is None else limit
     try:
-        messages = conn.execute(SELECT_MESSAGES, (email,)).fetchall()
+        # plain tuples, in the column order of the query, are much cheaper to build than sqlite3.Row
+        query = conn.cursor()
+        query.row_factory = None
+        if before:
+            date_posted, post_id = before
+            query.execute(SELECT_MESSAGES_BEFORE, (email, date_posted, date_posted, post_id, limit))
+        else:
+            query.execute(SELECT_MESSAGES, (email, limit))
+        messages = query.fetchall()
         return messages
     except sqlite3.Error:
         raise CouldNotFindMessages()
 
 
+def iter_messages(email, before=None):
+    """
+    Every message posted on a wall, newest first, read by batches as they are consumed. The connection goes back
+    to the pool between two batches, a slow client does not hold it, nor a read transaction, for the whole wall
+    :param email: Owner of the wall
+    :param before: (date_posted, id) of the last message already seen, None to start from the newest
+    :return: Generator of (id, to_user, from_user, content, media, date_posted) tuples
+    """
+    while True:
+        try:
+            messages = select_messages(email, before, STREAM_BATCH_SIZE)
+        finally:
+            close_db()
+
+        for message in messages:
+            yield message
+        if len(messages) < STREAM_BATCH_SIZE:
+            return
+
+        last = messages[-1]
+        before = (last[5], last[0])
+
+
+def search_messages(expression, after=None, limit=SEARCH_PAGE_SIZE):
+    """
+    Messages of every wall matching a full-text query, best matches first
+    :param expression: FTS5 query
+    :param after: (rank, id) of the last message already seen, None for the first page
+    :param limit: Maximum number of messages
+    :return: (id, to_user, from_user, content, media, date_posted, snippet, rank) tuples
+    """
+    query = get_connection().cursor()
+    query.row_factory = None
+    snippet = SEARCH_SNIPPET_MARKUP + (SEARCH_SNIPPET_TOKENS,)
+    try:
+        if after:
+            rank, post_id = after
+            query.execute(SEARCH_MESSAGES_AFTER, snippet + (expression, rank, rank, post_id, limit))
+        else:
+            query.execute(SEARCH_MESSAGES, snippet + (expression, limit))
+        return query.fetchall()
+    except sqlite3.Error:
+        raise CouldNotSearchMessages()
+    finally:
+        query.close()
+
+
+def rebuild_search_index(conn):
+    """
+    Index every post again, for databases whose index is missing posts or went out of sync with them
+    (a VACUUM may renumber the rowids of posts)
+    :param conn: Opened connection
+    :return:
+    """
+    with conn:
+        conn.execute(REBUILD_SEARCH_INDEX)
+        conn.execute(OPTIMIZE_SEARCH_INDEX)
+
+
+def rebuild_feeds(conn):
+    """
+    Fill every feed again from the posts and contacts, for databases whose feeds went out of sync with them
+    (a VACUUM may renumber the rowids of posts)
+    :param conn: Opened connection
+    :return:
+    """
+    with conn:
+        conn.execute(DELETE_FEEDS)
+        conn.execute(migrations.FILL_FEEDS)
+
+
+def select_number_of_messages(email):
+    conn = get_connection()
+    try:
+        number_of_messages = conn.execute(SELECT_NUMBER_OF_MESSAGES, (email,)).fetchone()
+        return number_of_messages["number_posts"] if number_of_messages else 0
+    except sqlite3.Error:
+        raise CouldNotFindMessages()
+
+
+def select_statistics(emails):
+    """
+    Number of posts and page views of several users, fetched in batches
+    :param emails: Users to look up
+    :return: {email: (number_posts, number_views)}
+    """
+    conn = get_connection()
+    emails = list(emails)
+    statistics = {}
+    try:
+        for start in range(0, len(emails), STATISTICS_BATCH_SIZE):
+            batch = emails[start:start + STATISTICS_BATCH_SIZE]
+            query = SELECT_STATISTICS.format(", ".join("?" * len(batch)))
+            for row in conn.execute(query, batch):
+                number_views = row["number_views"] + page_views_accumulator(g.db_pool.filename).pending(row["email"])
+                statistics[row["email"]] = (row["number_posts"], number_views)
+        return statistics
+    except sqlite3.Error:
+        raise CouldNotFindMessages()
+
+
 class CouldNotInsertMessage(Exception):
     pass
 
 
 def insert_message(to_user_email, from_user_email, message=None, media=None):
-    conn = g.db
+    def mutation(conn):
+        post_id = conn.execute(INSERT_MESSAGE, (to_user_email, from_user_email, message, media)).lastrowid
+        if to_user_email != from_user_email:
+            conn.executemany(INSERT_CONTACT, ((to_user_email, from_user_email), (from_user_email, to_user_email)))
+        conn.executemany(INSERT_FEED_ENTRY, ((user, post_id) for user in {to_user_email, from_user_email}))
+        return post_id
+
     try:
-        conn.execute(INSERT_MESSAGE, (to_user_email, from_user_email, message, media))
-        conn.commit()
+        post_id = _write(mutation)
     except sqlite3.Error:
         raise CouldNotInsertMessage()
 
+    filename = g.db_pool.filename
+    feed_trimmer(filename).add({to_user_email, from_user_email})
+    # the feeds of the contacts of the author are written after the poster got their answer
+    gevent.spawn(_fan_out, filename, from_user_email, post_id)
+
+
+def _fan_out(filename, from_user_email, post_id):
+    def mutation(conn):
+        contacts = [contact for contact, in conn.execute(SELECT_CONTACTS, (from_user_email,))]
+        conn.executemany(INSERT_FEED_ENTRY, ((contact, post_id) for contact in contacts))
+        return contacts
+
+    try:
+        contacts = get_writer(filename).submit(mutation)
+    except sqlite3.Error as e:
+        print("Could not add post {} to the feeds of the contacts of {}: {}".format(post_id, from_user_email, e))
+        return
+    feed_trimmer(filename).add(contacts)
+
+
+class CouldNotFindFeed(Exception):
+    pass
+
+
+def select_feed(email, before=None, limit=MESSAGES_PAGE_SIZE):
+    """
+    Messages of the feed of a user, newest first, read from a single range of the feeds table
+    :param email: Owner of the feed
+    :param before: (date_posted, id) of the last message already seen, None for the first page
+    :param limit: Maximum number of messages
+    :return: (id, to_user, from_user, content, media, date_posted) tuples
+    """
+    query = get_connection().cursor()
+    query.row_factory = None
+    try:
+        if before:
+            date_posted, post_id = before
+            query.execute(SELECT_FEED_BEFORE, (email, date_posted, date_posted, post_id, limit))
+        else:
+            query.execute(SELECT_FEED, (email, limit))
+        return query.fetchall()
+    except sqlite3.Error:
+        raise CouldNotFindFeed()
+    finally:
+        query.close()
+
+
+class FeedTrimmer(object):
+    def __init__(self, filename, length=FEED_LENGTH, interval=FEED_TRIM_INTERVAL):
+        """
+        Cuts the feeds that received posts back to their length, all of them in one transaction,
+        so posting does not wait for it
+        :param filename: Database file
+        :param length: Entries kept in a feed
+        :param interval: Seconds between two trims
+        :return:
+        """
+        self.writer = get_writer(filename)
+        self.length = length
+        self.interval = interval
+        self._touched = set()
+        self._trimmer = None
+
+    def add(self, users):
+        self._touched.update(users)
+        if self._trimmer is None or self._trimmer.dead:
+            self._trimmer = gevent.spawn(self._run)
+
+    def _run(self):
+        while self._touched:
+            gevent.sleep(self.interval)
+            self.trim()
+
+    def trim(self):
+        users, self._touched = self._touched, set()
+
+        def mutation(conn):
+            for user in users:
+                boundary = conn.execute(SELECT_FEED_BOUNDARY, (user, self.length)).fetchone()
+                if boundary:
+                    date_posted, post_id = boundary
+                    conn.execute(DELETE_FEED_ENTRIES, (user, date_posted, date_posted, post_id))
+
+        try:
+            self.writer.submit(mutation)
+        except sqlite3.Error as e:
+            print("Could not trim feeds: {}".format(e))
+            self._touched.update(users)
+
+
+_feed_trimmers = {}
+
+
+def feed_trimmer(filename):
+    if filename not in _feed_trimmers:
+        _feed_trimmers[filename] = FeedTrimmer(filename)
+
+    return _feed_trimmers[filename]
+
 
 class CouldNotFindPageView(Exception):
     pass
 
 
 def select_page_views(email):
-    conn = g.db
+    conn = get_connection()
     try:
         number_of_views = conn.execute(SELECT_PAGE_VIEWS, (email,)).fetchone()
-        return number_of_views["number_views"] if number_of_views else 0
+        pending = page_views_accumulator(g.db_pool.filename).pending(email)
+        return (number_of_views["number_views"] if number_of_views else 0) + pending
     except sqlite3.Error:
         raise CouldNotFindPageView()
 
 
 def persist_page_views(email):
-    conn = g.db
-    try:
-        conn.execute(INSERT_PAGE_VIEWS, (email,))
-        conn.execute(UPDATE_PAGE_VIEWS, (email,))
-        conn.commit()
-    except sqlite3.Error:
-        raise CouldNotFindPageView()
+    page_views_accumulator(g.db_pool.filename).add(email)
+
+
+class PageViewAccumulator(object):
+    def __init__(self, pool, interval=PAGE_VIEWS_FLUSH_INTERVAL, max_pending=PAGE_VIEWS_FLUSH_SIZE):
+        """
+        Counts page views in memory and writes them in a single transaction
+        :param pool: Pool of the database to write to
+        :param interval: Seconds before pending views are written
+        :param max_pending: Number of pending views that triggers a write right away
+        :return:
+        """
+        self.pool = pool
+        self.writer = get_writer(pool.filename)
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = Counter()
+        self._flushing = Counter()
+        self._count = 0
+        self._wakeup = gevent.event.Event()
+        self._flusher = None
+
+    def add(self, email):
+        self._pending[email] += 1
+        self._count += 1
+
+        if self._flusher is None or self._flusher.dead:
+            self._flusher = gevent.spawn(self._run)
+        if self._count >= self.max_pending:
+            self._wakeup.set()
+
+    def pending(self, email):
+        return self._pending.get(email, 0) + self._flushing.get(email, 0)
+
+    def _run(self):
+        while self._pending:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        pending, self._pending, self._count = self._pending, Counter(), 0
+        self._flushing.update(pending)
+
+        written = []
+
+        def mutation(conn):
+            conn.executemany(INSERT_PAGE_VIEWS, ((email,) for email in pending))
+            conn.executemany(UPDATE_PAGE_VIEWS, ((views, email) for email, views in pending.items()))
+            # the writer commits before yielding to another greenlet, no reader sees the views twice
+            self._forget_flushing(pending)
+            written.append(True)
+
+        try:
+            self.writer.submit(mutation)
+        except sqlite3.Error as e:
+            print("Could not write page views: {}".format(e))
+            self._pending.update(pending)
+            self._count += sum(pending.values())
+        finally:
+            if not written:
+                self._forget_flushing(pending)
+
+    def _forget_flushing(self, views):
+        self._flushing.subtract(views)
+        self._flushing += Counter()
+
+
+_page_views = {}
+
+
+def page_views_accumulator(filename):
+    if filename not in _page_views:
+        _page_views[filename] = PageViewAccumulator(get_pool(filename))
+
+    return _page_views[filename]
+
+
+@atexit.register
+def flush_page_views():
+    for accumulator in _page_views.values():
+        accumulator.flush()
 
 
 class MediaDoesNotExists(Exception):
@@ -202,7 +993,7 @@ class MediaDoesNotExists(Exception):
 
 
 def select_media(name):
-    conn = g.db
+    conn = get_connection()
     try:
         media = conn.execute(SELECT_MEDIA, (name,)).fetchone()
         if not media:
@@ -217,9 +1008,32 @@ class CouldNotInsertMedia(Exception):
     pass
 
 
-def insert_media(user_email, name):
-    conn = g.db
+def insert_media(user_email, name, content_hash=None):
+    try:
+        _write(lambda conn: conn.execute(INSERT_MEDIA, (user_email, name, content_hash)))
+    except sqlite3.Error:
+        raise CouldNotInsertMedia()
+
+
+def select_media_variant(content_hash, size):
+    """
+    :return: (variant_hash, mimetype) of the variant, None if it was not created (yet)
+    """
+    conn = get_connection()
+    try:
+        variant = conn.execute(SELECT_MEDIA_VARIANT, (content_hash, size)).fetchone()
+        return (variant["variant_hash"], variant["mimetype"]) if variant else None
+    except sqlite3.Error:
+        return None
+
+
+def select_media_variant_sizes(content_hash):
+    conn = get_connection()
+    return {row["size"] for row in conn.execute(SELECT_MEDIA_VARIANT_SIZES, (content_hash,))}
+
+
+def insert_media_variant(content_hash, size, variant_hash, mimetype):
     try:
-        conn.execute(INSERT_MEDIA, (user_email, name,))
+        _write(lambda conn: conn.execute(INSERT_MEDIA_VARIANT, (content_hash, size, variant_hash, mimetype)))
     except sqlite3.Error:
-        raise CouldNotInsertMedia()
\ No newline at end of file
+        raise CouldNotInsertMedia()
@@ -0,0 +1,100 @@
+import os
+import uuid
+import mimetypes
+
+from flask import request, Response
+from werkzeug.http import quote_etag
+from werkzeug.wsgi import wrap_file
+
+CHUNK_SIZE = 64 * 1024
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def send_file_cached(path, etag, mimetype=None, cache_control=IMMUTABLE_CACHE_CONTROL, headers=None):
+    """
+    Send a file with a strong ETag, answering conditional (304) and byte range (206) requests
+    :param path: File to send
+    :param etag: Strong validator of the file content (unquoted)
+    :param mimetype: Content type, guessed from the path if omitted
+    :param cache_control: Cache-Control header value
+    :param headers: Additional headers
+    :return:
+    """
+    size = os.path.getsize(path)
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    base_headers = [("ETag", quote_etag(etag)), ("Cache-Control", cache_control), ("Accept-Ranges", "bytes")]
+    base_headers.extend(headers or [])
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=base_headers)
+
+    ranges = _requested_ranges(size, etag)
+    if ranges is None:
+        body = wrap_file(request.environ, open(path, "rb"), CHUNK_SIZE)
+        return Response(body, 200, base_headers + [("Content-Length", str(size))],
+                        mimetype=mimetype, direct_passthrough=True)
+
+    if not ranges:
+        return Response(status=416, headers=base_headers + [("Content-Range", "bytes */{}".format(size))])
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        content_range = "bytes {}-{}/{}".format(start, stop - 1, size)
+        return Response(_read_range(path, start, stop), 206,
+                        base_headers + [("Content-Range", content_range), ("Content-Length", str(stop - start))],
+                        mimetype=mimetype, direct_passthrough=True)
+
+    boundary = uuid.uuid4().hex
+    parts = [("\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n"
+              .format(boundary, mimetype, start, stop - 1, size), start, stop) for start, stop in ranges]
+    closing = "\r\n--{}--\r\n".format(boundary)
+    length = sum(len(header) + stop - start for header, start, stop in parts) + len(closing)
+
+    return Response(_read_ranges(path, parts, closing), 206,
+                    base_headers + [("Content-Length", str(length))],
+                    mimetype="multipart/byteranges; boundary=" + boundary, direct_passthrough=True)
+
+
+def _requested_ranges(size, etag):
+    """
+    :return: None to send the whole file, otherwise the list of satisfiable [start, stop) ranges
+    """
+    requested = request.range
+    if requested is None or requested.units != "bytes":
+        return None
+
+    if_range = request.if_range
+    if (if_range.etag or if_range.date) and if_range.etag != etag:
+        return None
+
+    ranges = []
+    for start, stop in requested.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+
+    return ranges
+
+
+def _read_range(path, start, stop):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _read_ranges(path, parts, closing):
+    for header, start, stop in parts:
+        yield header
+        for chunk in _read_range(path, start, stop):
+            yield chunk
+    yield closing
@@ -0,0 +1,73 @@
+import os
+import multiprocessing
+
+import gevent
+import gevent.monkey
+import werkzeug.security as security
+
+DEFAULT_METHOD = "pbkdf2:sha256:50000"
+
+
+class HashingPoolSaturatedError(Exception):
+    pass
+
+
+class PasswordHasher(object):
+    def __init__(self, workers=2, max_pending=32, method=DEFAULT_METHOD):
+        """
+        Hashes passwords in worker processes so the gevent hub keeps serving other connections
+        :param workers: Number of hashing processes, 0 hashes in the calling greenlet
+        :param max_pending: Hashes queued or running before new ones are refused
+        :param method: Werkzeug hashing method used for new hashes
+        :return:
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.method = method
+        self._pending = 0
+        self._pid = None
+        self._processes = None
+
+    def generate(self, password):
+        return self._run(security.generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self._run(security.check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return not pwhash.startswith(self.method + "$")
+
+    def close(self):
+        if self._processes is not None:
+            self._processes.terminate()
+            self._processes = None
+
+    def _run(self, function, *args):
+        if self.workers <= 0:
+            return function(*args)
+
+        if self._pending >= self.max_pending:
+            raise HashingPoolSaturatedError()
+
+        self._pending += 1
+        try:
+            processes, threads = self._get_pools()
+            if processes is None:
+                return threads.apply(function, args)
+            # a native thread waits on the process so only that thread blocks, not the hub
+            return threads.apply(processes.apply, (function, args))
+        finally:
+            self._pending -= 1
+
+    def _get_pools(self):
+        if self._pid != os.getpid():
+            # pools are not inherited by forked workers
+            self._pid = os.getpid()
+            self._processes = None
+            # multiprocessing deadlocks once threading is monkey patched, hashlib's PBKDF2 releases
+            # the GIL so hashing in the native threads alone still keeps the hub free
+            if "threading" not in gevent.monkey.saved:
+                self._processes = multiprocessing.Pool(self.workers)
+
+        # the threadpool of the hub, sized by the server for every blocking call of the worker
+        return self._processes, gevent.get_hub().threadpool
@@ -0,0 +1,166 @@
+import bisect
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+enabled = False
+
+_registry = []
+
+
+def enable():
+    """Start recording, until then every metric ignores what it is given"""
+    global enabled
+    enabled = True
+
+
+def render():
+    """
+    :return: Every metric, in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in _registry:
+        lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        for suffix, labels, value in metric.samples():
+            lines.append("{}{}{} {}".format(metric.name, suffix, _format_labels(labels), _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        :param name: Metric name
+        :param documentation: Help text
+        :param labels: Label names, their values are given in the same order when recording
+        :return:
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def samples(self):
+        for label_values, value in sorted(self._values.items()):
+            yield "", zip(self.labels, label_values), value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values):
+        self.add(1, *label_values)
+
+    def add(self, amount, *label_values):
+        if enabled:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        """
+        :param function: Called when the metrics are rendered, for a gauge without labels read from elsewhere
+        """
+        super(Gauge, self).__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, *label_values):
+        if enabled:
+            self._values[label_values] = value
+
+    def samples(self):
+        if self.function is not None:
+            return iter([("", [], self.function())])
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        if not enabled:
+            return
+
+        observed = self._values.get(label_values)
+        if observed is None:
+            # one count per bucket plus +Inf, then the sum
+            observed = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        observed[bisect.bisect_left(self.buckets, value)] += 1
+        observed[-1] += value
+
+    def samples(self):
+        for label_values, observed in sorted(self._values.items()):
+            labels = zip(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), observed):
+                cumulative += count
+                yield "_bucket", labels + [("le", bound)], cumulative
+            yield "_sum", labels, observed[-1]
+            yield "_count", labels, cumulative
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + "}"
+
+
+def _escape(value):
+    if isinstance(value, float):
+        value = _format_value(value)
+    return unicode(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "twidder_http_request_duration_seconds", "Time spent handling a request, by route",
+    ("route", "method", "status"))
+
+SQLITE_QUERY_DURATION = Histogram(
+    "twidder_sqlite_query_duration_seconds", "Time spent executing a statement, by database_helper query",
+    ("query",))
+
+SQLITE_LOCKED = Counter(
+    "twidder_sqlite_locked_total", "Statements that gave up waiting for a database lock", ("query",))
+
+SQLITE_LOCK_WAIT = Histogram(
+    "twidder_sqlite_lock_wait_seconds", "Time a group commit waited for the write lock")
+
+SQLITE_COMMIT_DURATION = Histogram(
+    "twidder_sqlite_commit_duration_seconds", "Time spent writing and committing a group of mutations")
+
+SQLITE_COMMIT_SIZE = Histogram(
+    "twidder_sqlite_commit_mutations", "Mutations committed together", buckets=SIZE_BUCKETS)
+
+POOL_WAIT = Histogram(
+    "twidder_pool_wait_seconds", "Time spent waiting for a free connection of the pool")
+
+WEBSOCKET_CONNECTIONS = Gauge(
+    "twidder_websocket_connections", "Authenticated websockets connected to this process")
+
+WEBSOCKET_OPENED = Counter(
+    "twidder_websocket_opened_total", "Websockets opened")
+
+STATISTICS_BROADCAST_DURATION = Histogram(
+    "twidder_statistics_broadcast_duration_seconds", "Time spent sending a round of statistics to websockets")
+
+STATISTICS_BROADCAST_SIZE = Histogram(
+    "twidder_statistics_broadcast_recipients", "Websockets a round of statistics is sent to", buckets=SIZE_BUCKETS)
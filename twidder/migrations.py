@@ -0,0 +1,162 @@
+import sqlite3
+
+# entries kept in a feed, database_helper trims the feeds to as many
+FEED_LENGTH = 500
+
+# the latest FEED_LENGTH posts on and by each user, and by their contacts, also used to rebuild the feeds
+FILL_FEEDS = (
+    "INSERT INTO feeds(user, date_posted, post_id) "
+    "  SELECT user, date_posted, post_id FROM ("
+    "    SELECT user, date_posted, post_id, "
+    "      ROW_NUMBER() OVER (PARTITION BY user ORDER BY date_posted DESC, post_id DESC) AS position "
+    "    FROM ("
+    "      SELECT to_user AS user, date_posted, rowid AS post_id FROM posts "
+    "      UNION SELECT from_user, date_posted, rowid FROM posts "
+    "      UNION SELECT contacts.user, posts.date_posted, posts.rowid "
+    "        FROM contacts JOIN posts ON posts.from_user = contacts.contact"
+    "    )"
+    "  ) WHERE position <= {}".format(FEED_LENGTH)
+)
+
+# Each migration is (version, description, script). The version reached is stored in PRAGMA user_version,
+# so a migration only ever runs once per database. Never edit a released migration, append a new one.
+MIGRATIONS = (
+    (1, "Index walls by recipient and date", (
+        "CREATE INDEX IF NOT EXISTS posts_to_user_date ON posts(to_user, date_posted);"
+    )),
+
+    (2, "Key sessions by user and index them by token", (
+        "CREATE TABLE sessions_migrated("
+        "  user TEXT PRIMARY KEY NOT NULL,"
+        "  token TEXT NOT NULL,"
+        "  FOREIGN KEY (user) REFERENCES users(email)"
+        ") WITHOUT ROWID;"
+        "INSERT INTO sessions_migrated(user, token) SELECT user, token FROM sessions;"
+        "DROP TABLE sessions;"
+        "ALTER TABLE sessions_migrated RENAME TO sessions;"
+        "CREATE UNIQUE INDEX sessions_token ON sessions(token);"
+    )),
+
+    (3, "Key page views by user", (
+        "CREATE TABLE page_views_migrated("
+        "  user TEXT PRIMARY KEY NOT NULL,"
+        "  number_views INTEGER NOT NULL DEFAULT 0,"
+        "  FOREIGN KEY (user) REFERENCES users(email)"
+        ") WITHOUT ROWID;"
+        "INSERT INTO page_views_migrated(user, number_views) "
+        "  SELECT user, MAX(number_views) FROM page_views GROUP BY user;"
+        "DROP TABLE page_views;"
+        "ALTER TABLE page_views_migrated RENAME TO page_views;"
+    )),
+
+    (4, "Count posts per wall with triggers", (
+        "CREATE TABLE post_counts("
+        "  user TEXT PRIMARY KEY NOT NULL,"
+        "  number_posts INTEGER NOT NULL DEFAULT 0,"
+        "  FOREIGN KEY (user) REFERENCES users(email)"
+        ") WITHOUT ROWID;"
+        "INSERT INTO post_counts(user, number_posts) SELECT to_user, COUNT(*) FROM posts GROUP BY to_user;"
+        "CREATE TRIGGER posts_count_insert AFTER INSERT ON posts BEGIN"
+        "  INSERT OR IGNORE INTO post_counts(user) VALUES (NEW.to_user);"
+        "  UPDATE post_counts SET number_posts = number_posts + 1 WHERE user = NEW.to_user;"
+        "END;"
+        "CREATE TRIGGER posts_count_delete AFTER DELETE ON posts BEGIN"
+        "  UPDATE post_counts SET number_posts = number_posts - 1 WHERE user = OLD.to_user;"
+        "END;"
+    )),
+
+    (5, "Store a content hash of media", (
+        "ALTER TABLE media ADD COLUMN content_hash TEXT;"
+    )),
+
+    (6, "Store resized and transcoded variants of media", (
+        "CREATE TABLE media_variants("
+        "  content_hash TEXT NOT NULL,"
+        "  size TEXT NOT NULL,"
+        "  variant_hash TEXT NOT NULL,"
+        "  mimetype TEXT NOT NULL,"
+        "  PRIMARY KEY (content_hash, size)"
+        ") WITHOUT ROWID;"
+    )),
+
+    (7, "Index the content of posts for full-text search", (
+        # external content: the index refers to posts by rowid and reads the text back from posts
+        "CREATE VIRTUAL TABLE posts_search USING fts5(content, content='posts', tokenize='unicode61');"
+        "INSERT INTO posts_search(posts_search) VALUES ('rebuild');"
+        "CREATE TRIGGER posts_search_insert AFTER INSERT ON posts BEGIN"
+        "  INSERT INTO posts_search(rowid, content) VALUES (NEW.rowid, NEW.content);"
+        "END;"
+        "CREATE TRIGGER posts_search_delete AFTER DELETE ON posts BEGIN"
+        "  INSERT INTO posts_search(posts_search, rowid, content) VALUES ('delete', OLD.rowid, OLD.content);"
+        "END;"
+        "CREATE TRIGGER posts_search_update AFTER UPDATE OF content ON posts BEGIN"
+        "  INSERT INTO posts_search(posts_search, rowid, content) VALUES ('delete', OLD.rowid, OLD.content);"
+        "  INSERT INTO posts_search(rowid, content) VALUES (NEW.rowid, NEW.content);"
+        "END;"
+    )),
+
+    (8, "Materialize the feed of each user", (
+        # users who posted on the wall of one another
+        "CREATE TABLE contacts("
+        "  user TEXT NOT NULL,"
+        "  contact TEXT NOT NULL,"
+        "  PRIMARY KEY (user, contact)"
+        ") WITHOUT ROWID;"
+        "INSERT OR IGNORE INTO contacts(user, contact) "
+        "  SELECT to_user, from_user FROM posts WHERE to_user != from_user "
+        "  UNION SELECT from_user, to_user FROM posts WHERE to_user != from_user;"
+        # posts on and by a user, and by their contacts, newest first
+        "CREATE TABLE feeds("
+        "  user TEXT NOT NULL,"
+        "  date_posted TIMESTAMP NOT NULL,"
+        "  post_id INTEGER NOT NULL,"
+        "  PRIMARY KEY (user, date_posted, post_id)"
+        ") WITHOUT ROWID;"
+        + FILL_FEEDS + ";"
+    )),
+)
+
+
+class MigrationError(Exception):
+    def __init__(self, version, error):
+        super(MigrationError, self).__init__("Migration {} failed: {}".format(version, error))
+        self.version = version
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def migrate(conn, target=None):
+    """
+    Apply every migration newer than the database version
+    :param conn: Opened connection
+    :param target: Version to stop at (latest by default)
+    :return: Versions that were applied
+    """
+    target = latest_version() if target is None else target
+    applied = []
+
+    for version, description, script in MIGRATIONS:
+        if version <= current_version(conn) or version > target:
+            continue
+
+        try:
+            conn.executescript("BEGIN; {} PRAGMA user_version = {}; COMMIT;".format(script, version))
+        except sqlite3.Error as e:
+            _rollback(conn)
+            raise MigrationError(version, e)
+        applied.append(version)
+
+    return applied
+
+
+def _rollback(conn):
+    try:
+        conn.execute("ROLLBACK")
+    except sqlite3.Error:
+        pass
@@ -0,0 +1,95 @@
+import os
+import re
+import time
+import errno
+import signal
+from collections import Counter
+
+import gevent
+
+DEFAULT_INTERVAL = 0.005
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval=DEFAULT_INTERVAL, directory="profiles"):
+        """
+        Samples the stack of chosen greenlets on a CPU time timer (ITIMER_PROF), the other greenlets
+        are not recorded, and writes each profile as collapsed stacks (one "frame;frame;frame count"
+        line per stack, the input of flamegraph.pl and speedscope)
+        :param interval: Seconds of CPU time between two samples
+        :param directory: Directory the profiles are written to
+        :return:
+        """
+        self.interval = interval
+        self.directory = directory
+        self._profiles = {}
+        self._installed = False
+
+    def start(self, name):
+        """
+        Profile the current greenlet until stop is called
+        :param name: Name of the profile, used in its file name
+        :return: False if this process cannot be profiled
+        """
+        if not self._install():
+            return False
+
+        if not self._profiles:
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self._profiles[gevent.getcurrent()] = (name, time.time(), Counter())
+        return True
+
+    def stop(self):
+        """
+        :return: Path of the profile written, None if the current greenlet was not profiled
+        """
+        profile = self._profiles.pop(gevent.getcurrent(), None)
+        if profile is None:
+            return None
+        if not self._profiles:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+
+        name, started, stacks = profile
+        return self._write(name, started, stacks)
+
+    def _install(self):
+        if not self._installed:
+            try:
+                signal.signal(signal.SIGPROF, self._sample)
+                self._installed = True
+            except (ValueError, AttributeError) as e:
+                # signals can only be handled by the main thread, and not on every platform
+                print("Profiling is not available: {}".format(e))
+        return self._installed
+
+    def _sample(self, signum, frame):
+        profile = self._profiles.get(gevent.getcurrent())
+        if profile is None:
+            return
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{} ({}:{})".format(code.co_name, _short_path(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        profile[2][";".join(reversed(stack))] += 1
+
+    def _write(self, name, started, stacks):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        path = os.path.join(self.directory, "{}-{}-{}.folded".format(
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(started)), re.sub(r"[^\w.-]+", "_", name).strip("_"),
+            os.getpid()))
+        with open(path, "a") as f:
+            for stack, count in stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        return path
+
+
+def _short_path(filename):
+    # the last two components tell the many __init__.py apart without the noise of site-packages
+    return "/".join(filename.replace("\\", "/").rsplit("/", 2)[-2:])
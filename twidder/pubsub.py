@@ -0,0 +1,180 @@
+import os
+import time
+import uuid
+import sqlite3
+from collections import defaultdict
+
+import gevent
+from flask import json
+
+POLL_INTERVAL = 0.1
+
+RETENTION = 60
+
+# milliseconds SQLite waits for a lock, the whole process waits with it, a busy queue is retried at the next poll
+BUSY_TIMEOUT = 50
+
+CREATE_MESSAGES = (
+    "CREATE TABLE IF NOT EXISTS messages("
+    "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    "  origin TEXT NOT NULL,"
+    "  channel TEXT NOT NULL,"
+    "  payload TEXT NOT NULL,"
+    "  created REAL NOT NULL"
+    ")"
+)
+
+INSERT_MESSAGE = "INSERT INTO messages(origin, channel, payload, created) VALUES (?, ?, ?, ?)"
+
+SELECT_MESSAGES = "SELECT id, origin, channel, payload FROM messages WHERE id > ? ORDER BY id"
+
+SELECT_LAST_MESSAGE = "SELECT COALESCE(MAX(id), 0) FROM messages"
+
+DELETE_OLD_MESSAGES = "DELETE FROM messages WHERE created < ?"
+
+
+class PubSub(object):
+    def __init__(self):
+        """
+        In-process publish/subscribe, callbacks run synchronously in the publisher's greenlet
+        :return:
+        """
+        self.origin = str(uuid.uuid4())
+        self._subscribers = defaultdict(list)
+
+    def subscribe(self, channel, callback):
+        self._subscribers[channel].append(callback)
+
+    def publish(self, channel, message):
+        self._dispatch(channel, message)
+
+    def close(self):
+        pass
+
+    def _dispatch(self, channel, message):
+        for callback in self._subscribers[channel]:
+            try:
+                callback(message)
+            except Exception as e:
+                print("Subscriber of {} failed: {}".format(channel, e))
+
+
+class SqlitePubSub(PubSub):
+    def __init__(self, filename, poll_interval=POLL_INTERVAL, retention=RETENTION):
+        """
+        Publish/subscribe shared by every process using the same broker file
+        :param filename: SQLite file used as a message queue
+        :param poll_interval: Seconds between two reads of the queue
+        :param retention: Seconds before a message is removed from the queue
+        :return:
+        """
+        super(SqlitePubSub, self).__init__()
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._pid = None
+        self._conn = None
+        self._last_id = None
+        self._poller = None
+        self._outbox = []
+        self._sender = None
+
+    def publish(self, channel, message):
+        """
+        Local subscribers are called at once, the other processes get the message once the queue is written,
+        the messages published meanwhile are written in the same transaction
+        :param channel: Channel name
+        :param message: JSON serializable message
+        :return:
+        """
+        self._ensure_started()
+        self._outbox.append((self.origin, channel, json.dumps(message), time.time()))
+        if self._sender is None or self._sender.dead:
+            self._sender = gevent.spawn(self._send)
+        self._dispatch(channel, message)
+
+    def subscribe(self, channel, callback):
+        super(SqlitePubSub, self).subscribe(channel, callback)
+        self._ensure_started()
+
+    def close(self):
+        if self._sender is not None:
+            # the last messages get a chance to reach the other processes
+            self._sender.join(timeout=1)
+            self._sender.kill()
+            self._sender = None
+        if self._poller is not None:
+            self._poller.kill()
+            self._poller = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            # forked worker, its messages must not be mistaken for the parent's
+            self._pid = os.getpid()
+            self.origin = str(uuid.uuid4())
+            self._conn = None
+            self._poller = None
+            self._outbox = []
+            self._sender = None
+
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            # the queue is short-lived, losing its last messages to a power cut is fine, waiting on fsync is not
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.execute("PRAGMA busy_timeout = {}".format(BUSY_TIMEOUT))
+            self._conn.execute(CREATE_MESSAGES)
+            self._last_id = self._conn.execute(SELECT_LAST_MESSAGE).fetchone()[0]
+
+        if self._poller is None or self._poller.dead:
+            self._poller = gevent.spawn(self._poll)
+
+    def _send(self):
+        while self._outbox:
+            messages, self._outbox = self._outbox, []
+            try:
+                with self._conn:
+                    self._conn.executemany(INSERT_MESSAGE, messages)
+            except sqlite3.OperationalError as e:
+                # locked by another process, kept for the next attempt unless too old to matter
+                deadline = time.time() - self.retention
+                self._outbox[:0] = [message for message in messages if message[3] > deadline]
+                print("Could not write to the message queue: {}".format(e))
+                gevent.sleep(self.poll_interval)
+            except sqlite3.Error as e:
+                print("Dropped {} messages: {}".format(len(messages), e))
+
+    def _poll(self):
+        last_cleanup = time.time()
+        while True:
+            gevent.sleep(self.poll_interval)
+            try:
+                self._receive()
+                if time.time() - last_cleanup > self.retention:
+                    with self._conn:
+                        self._conn.execute(DELETE_OLD_MESSAGES, (time.time() - self.retention,))
+                    last_cleanup = time.time()
+            except sqlite3.Error as e:
+                print("Could not read the message queue: {}".format(e))
+
+    def _receive(self):
+        for message_id, origin, channel, payload in self._conn.execute(SELECT_MESSAGES, (self._last_id,)).fetchall():
+            self._last_id = message_id
+            if origin != self.origin:
+                self._dispatch(channel, json.loads(payload))
+
+
+BACKENDS = {
+    "local": PubSub,
+    "sqlite": SqlitePubSub
+}
+
+
+def create_pubsub(backend="local", **options):
+    try:
+        return BACKENDS[backend](**options)
+    except KeyError:
+        raise ValueError("Unknown pub/sub backend: {}".format(backend))
@@ -1,9 +1,23 @@
+import time
 import datetime
 import base64, hmac, hashlib
 from functools import wraps
 from flask import request
 
 from . import app
+from cache import TTLCache
+
+REQUEST_WINDOW = datetime.timedelta(minutes=2)
+
+BODY_CHUNK_SIZE = 64 * 1024
+
+UNSIGNED_BODY_MIMETYPES = {"multipart/form-data", "application/x-www-form-urlencoded"}
+
+REPLAY_PROTECTED_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+REPLAY_CACHE_SIZE = 100000
+
+PROFILE_HEADER = "X-Profile"
 
 
 class MessageHasher(object):
@@ -16,9 +30,14 @@ class MessageHasher(object):
         """
         self.key = key
         self.hash_algorithm = hash_algorithm
+        self._keyed = hmac.HMAC(key, digestmod=hash_algorithm)
+
+    def hmac(self):
+        """Fresh HMAC, copied from a precomputed keyed state"""
+        return self._keyed.copy()
 
     def digest_message(self, *messages):
-        generator = hmac.HMAC(self.key, digestmod=self.hash_algorithm)
+        generator = self.hmac()
         for message in messages:
             generator.update(message)
 
@@ -33,36 +52,110 @@ class CouldNotValidateRequestError(Exception):
     pass
 
 
+# a request is accepted from REQUEST_WINDOW before its timestamp to REQUEST_WINDOW after it, its digest is kept
+# until the last of them whenever it was first seen
+replay_cache = TTLCache(REPLAY_CACHE_SIZE, 2 * REQUEST_WINDOW.total_seconds())
+
+
+def _is_in_window(time_sent):
+    """Clocks of the clients may be ahead of the server, but not by more than the window"""
+    return abs(datetime.datetime.utcnow() - time_sent) <= REQUEST_WINDOW
+
+
 def _validate_request(hasher):
     try:
         digest = base64.standard_b64decode(request.headers["X-Request-Hmac"] or "")
         timestamp = int(request.headers["X-Request-Timestamp"])
         time_sent = datetime.datetime.utcfromtimestamp(timestamp)
-    except KeyError:
+    except (KeyError, ValueError, TypeError):
         raise CouldNotValidateRequestError()
 
     session_token = (request.headers["X-Session-Token"]
                      if "X-Session-Token" in request.headers else "")
 
-    if datetime.datetime.utcnow() - time_sent > datetime.timedelta(minutes=2):
+    if not _is_in_window(time_sent):
         raise CouldNotValidateRequestError()
 
-    message = _get_message()
-    if not hasher.is_message_valid(digest, str(timestamp), session_token, message):
+    generator = hasher.hmac()
+    generator.update(str(timestamp))
+    generator.update(session_token)
+    is_body_signed = _hash_body(generator)
+    if not hmac.compare_digest(generator.hexdigest(), digest):
+        raise CouldNotValidateRequestError()
+
+    # two different form posts sent the same second share a digest, only signed bodies are unique
+    if is_body_signed and request.method in REPLAY_PROTECTED_METHODS:
+        _reject_replay(digest)
+
+
+def _hash_body(generator):
+    # the client does not sign form bodies
+    if request.mimetype in UNSIGNED_BODY_MIMETYPES:
+        return False
+
+    chunks = []
+    while True:
+        chunk = request.stream.read(BODY_CHUNK_SIZE)
+        if not chunk:
+            break
+        generator.update(chunk)
+        chunks.append(chunk)
+
+    # the stream is consumed, handlers read the body through get_data/get_json
+    request._cached_data = "".join(chunks)
+    return True
+
+
+def _reject_replay(digest):
+    key = (digest, request.method, request.full_path, request.headers.get("Authorization"))
+    if replay_cache.get(key) is not None:
         raise CouldNotValidateRequestError()
+    replay_cache.set(key, True)
+
+
+_hasher = None
 
 
-def _get_message():
-    if request.form:
-        return ""
-    return str(request.get_data() or "")
+def _get_hasher():
+    global _hasher
+    if _hasher is None or _hasher.key != app.config["SECRET_KEY"]:
+        _hasher = MessageHasher(app.config["SECRET_KEY"])
+    return _hasher
 
 
 def validate_request(f):
     @wraps(f)
     def decorator(*args, **kwargs):
-        message_hasher = MessageHasher(app.config["SECRET_KEY"])
-        _validate_request(message_hasher)
+        _validate_request(_get_hasher())
         return f(*args, **kwargs)
     return decorator
 
+
+def sign_profile_request(key, method, path, timestamp=None):
+    """
+    :return: Value of the X-Profile header asking to profile a request
+    """
+    timestamp = str(int(timestamp or time.time()))
+    return "{}:{}".format(timestamp, MessageHasher(key).digest_message(timestamp, method, path))
+
+
+def is_profiling_requested(key):
+    """
+    The X-Profile header is signed with a key of its own, the client secret is given to every browser
+    :param key: Key shared with whoever may profile the server, None if nobody may
+    :return: True if the request carries a recent profiling signature for its method and path
+    """
+    value = request.headers.get(PROFILE_HEADER)
+    if not (key and value):
+        return False
+
+    try:
+        timestamp, digest = value.encode("ascii").split(":", 1)
+        time_sent = datetime.datetime.utcfromtimestamp(int(timestamp))
+    except (ValueError, TypeError, UnicodeError):
+        return False
+
+    if not _is_in_window(time_sent):
+        return False
+
+    return MessageHasher(key).is_message_valid(digest, timestamp, request.method, request.path)
@@ -76,6 +76,7 @@ function Messages(messageTimeout) {
 function Wall(getProfileFunction, getMessagesFunction, postMessageFunction) {
 
     var posts = [];
+    var nextPage = null;
     var profile;
 
     var wallNode = Utils.createElement("", "wall_container");
@@ -109,14 +110,34 @@ function Wall(getProfileFunction, getMessagesFunction, postMessageFunction) {
     }
 
     function refreshView() {
-        wallNode.innerHTML = templates.use("wall", { posts: posts, profile: profile });
+        wallNode.innerHTML = templates.use("wall", { posts: posts, profile: profile, hasMore: !!nextPage });
         createHandlers();
     }
 
     function refreshWall() {
         getMessagesFunction(
+            null,
             function(response) {
-                posts = createPosts(response.data);
+                posts = createPosts(response.data.messages);
+                nextPage = response.data.next;
+                refreshView();
+            },
+            function(response) {
+                messages.newError(response.message);
+            }
+        );
+    }
+
+    function loadMorePosts() {
+        if (!nextPage) {
+            return;
+        }
+
+        getMessagesFunction(
+            nextPage,
+            function(response) {
+                posts = posts.concat(createPosts(response.data.messages));
+                nextPage = response.data.next;
                 refreshView();
             },
             function(response) {
@@ -141,6 +162,7 @@ function Wall(getProfileFunction, getMessagesFunction, postMessageFunction) {
     function createHandlers() {
         var postForm = wallNode.getElementsByClassName("wall_post_message")[0];
         var refreshButton = wallNode.getElementsByClassName("wall_refresh")[0];
+        var moreButton = wallNode.getElementsByClassName("wall_more")[0];
 
         postForm.onsubmit = function() {
             var message = postForm.elements["message"],
@@ -158,11 +180,19 @@ function Wall(getProfileFunction, getMessagesFunction, postMessageFunction) {
             refreshWall();
             return false;
         };
+
+        if (moreButton) {
+            moreButton.onclick = function() {
+                loadMorePosts();
+                return false;
+            };
+        }
     }
 
     function init() {
-        var messagesResponse = getMessagesFunction(function(response) {
-            posts = createPosts(response.data || []);
+        var messagesResponse = getMessagesFunction(null, function(response) {
+            posts = createPosts(response.data.messages || []);
+            nextPage = response.data.next;
             refreshView();
         });
         var profileResponse = getProfileFunction(function(response) {
@@ -246,7 +276,7 @@ function SignedInView(session) {
         var homeViewContainer = document.getElementById("home_view_container");
 
         var getHomeProfile = function(s, e) { session.getCurrentUserData(s, e); };
-        var getHomeMessages = function(s, e) { session.getCurrentUserMessages(s, e); };
+        var getHomeMessages = function(before, s, e) { session.getCurrentUserMessages(before, s, e); };
         var postHomeMessage = function(message, media, s, e) { session.postMessageOnWall(message, media, s, e) };
 
         var homeWall = new Wall(getHomeProfile, getHomeMessages, postHomeMessage);
@@ -266,7 +296,7 @@ function SignedInView(session) {
         var browseViewContainer = document.getElementById("browse_view_container");
 
         var getBrowseProfile = function(s, e) { session.getOtherUserDataByEmail(email, s, e); };
-        var getBrowseMessages = function(s, e) { session.getOtherUserMessagesByEmail(email, s, e); };
+        var getBrowseMessages = function(before, s, e) { session.getOtherUserMessagesByEmail(email, before, s, e); };
         var postBrowseMessage = function(message, media, s, e) { session.postMessage(message, media, email, s, e); };
 
         var browseWall = new Wall(getBrowseProfile, getBrowseMessages, postBrowseMessage);
@@ -514,9 +544,9 @@ function Session(server, notifySessionChange) {
                 .send();
         },
 
-        getCurrentUserMessages: function (onSuccess, onError) {
+        getCurrentUserMessages: function (before, onSuccess, onError) {
             server
-                .getUserMessagesByToken(sessionToken)
+                .getUserMessagesByToken(sessionToken, before)
                 .onSuccess(onSuccess || noCallback)
                 .onError(onError || noCallback)
                 .send();
@@ -551,9 +581,9 @@ function Session(server, notifySessionChange) {
                 .send();
         },
 
-        getOtherUserMessagesByEmail: function(email, onSuccess, onError){
+        getOtherUserMessagesByEmail: function(email, before, onSuccess, onError){
             server
-                .getUserMessagesByEmail(sessionToken, email)
+                .getUserMessagesByEmail(sessionToken, email, before)
                 .onSuccess(onSuccess)
                 .onError(onError)
                 .send();
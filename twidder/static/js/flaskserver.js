@@ -145,6 +145,10 @@ function Server(endpoint) {
         return JSON.stringify(data);
     }
 
+    function pageQuery(before) {
+        return before ? "?before=" + encodeURIComponent(before) : "";
+    }
+
     return {
         signIn: function(email, password) {
             var xhr = new XMLHttpRequest();
@@ -168,15 +172,24 @@ function Server(endpoint) {
             return new XhrSender(xhr, content);
         },
 
-        getUserMessagesByToken: function(token) {
+        /**
+         * @param {string} token
+         * @param {string} [before] cursor of the next page, first page if omitted
+         */
+        getUserMessagesByToken: function(token, before) {
             var xhr = new XMLHttpRequest();
-            xhr.open("GET", endpoint + "/messages", true);
+            xhr.open("GET", endpoint + "/messages" + pageQuery(before), true);
             return new XhrSender(xhr, "", token);
         },
 
-        getUserMessagesByEmail: function(token, email) {
+        /**
+         * @param {string} token
+         * @param {string} email
+         * @param {string} [before] cursor of the next page, first page if omitted
+         */
+        getUserMessagesByEmail: function(token, email, before) {
             var xhr = new XMLHttpRequest();
-            xhr.open("GET", endpoint + "/messages/" + email, true);
+            xhr.open("GET", endpoint + "/messages/" + email + pageQuery(before), true);
             return new XhrSender(xhr, "", token);
         },
 
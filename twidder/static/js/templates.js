@@ -16,6 +16,13 @@ function Templates() {
     }
 
     function compileTemplate(name, onCompletion) {
+        // the built bundle embeds the templates, no need to fetch them
+        if (typeof TEMPLATE_SOURCES !== "undefined" && TEMPLATE_SOURCES[name]) {
+            templates[name] = Handlebars.compile(TEMPLATE_SOURCES[name]);
+            onCompletionCallback(onCompletion);
+            return;
+        }
+
         var filename = TEMPLATE_PATH + name + ".hbs";
         var xhr = new XMLHttpRequest();
         xhr.open("GET", filename, true);
@@ -1,28 +1,102 @@
 import os
 import re
+import time
 import uuid
+import random
 import base64
+import hashlib
+import mimetypes
 import traceback
 
-import werkzeug.security as security
 from geventwebsocket import WebSocketError
-from flask import json, request, escape, abort, send_from_directory, render_template
+from flask import json, request, escape, abort, send_from_directory, render_template, Response, \
+    stream_with_context
 
 from . import app, sockets, STATIC_FOLDER, MEDIA_FOLDER, ALLOWED_MEDIA
-from security import validate_request, CouldNotValidateRequestError
+from security import validate_request, is_profiling_requested, CouldNotValidateRequestError
 import database_helper as db
+from broadcaster import StatisticsBroadcaster, Presence
+from pubsub import create_pubsub
+from cache import TTLCache
+from hashing import PasswordHasher, HashingPoolSaturatedError
+from file_response import send_file_cached
+from uploads import UploadRequest, spool, blob_path, staging_folder, store_file, hash_file
+from variants import VariantQueue, variants_of, variant_kind, render_variant
+import assets
+import metrics
+from profiler import SamplingProfiler
 
 SESSION_TOKEN = "X-Session-Token"
 
+# a variant still being created is served as the original when it is the same kind of media, which must not be
+# cached as the variant
+VARIANT_PENDING_CACHE_CONTROL = "public, no-cache"
+
+# clients allowed to read /metrics
+LOCAL_ADDRESSES = {"127.0.0.1", "::1"}
+
 COULD_NOT_POST_MESSAGE = "Could not post message."
 
+MESSAGES_RETRIEVED = "Messages successfully retrieved."
+
+# posts encoded before a chunk of a streamed wall is written out
+STREAM_CHUNK_SIZE = 50
+
 CONFIG = {
     "database": "database/database.db",
     "database_schema": "database/database.schema",
-    "min_password_length": 6
+    "database_pool_size": 8,
+    "write_batch_latency": 0.005,
+    "max_messages_page_size": 200,
+    "statistics_window": 0.25,
+    "presence_interval": 5,
+    # {"backend": "sqlite", "filename": "database/pubsub.db"} to share live updates between server processes
+    "pubsub": {"backend": "local"},
+    "min_password_length": 6,
+    "session_cache_size": 10000,
+    "session_cache_ttl": 60,
+    "password_hash_workers": 2,
+    "password_hash_queue": 32,
+    "password_hash_method": "pbkdf2:sha256:50000",
+    # bytes accepted per uploaded file extension
+    "media_size_limits": {
+        "jpg": 8 * 1024 * 1024,
+        "png": 8 * 1024 * 1024,
+        "mp3": 32 * 1024 * 1024,
+        "wav": 64 * 1024 * 1024,
+        "mp4": 256 * 1024 * 1024
+    },
+    "media_variant_workers": 2,
+    "media_variant_queue": 256,
+    # False for indented, sorted JSON responses, easier to read while debugging
+    "compact_json": True,
+    # Prometheus metrics on /metrics, for local clients only
+    "metrics": False,
+    # requests are profiled when they carry an X-Profile header signed with this key
+    # (see "manage.py profile-header"), or at random with this rate
+    "profile_key": None,
+    "profile_sample_rate": 0.0,
+    "profile_interval": 0.005,
+    "profile_directory": "profiles"
 }
 
-db.init_database(CONFIG["database"], CONFIG["database_schema"])
+# before any connection is opened, connections only time their queries when metrics are enabled
+if CONFIG["metrics"]:
+    metrics.enable()
+
+app.request_class = UploadRequest
+app.config["UPLOAD_SIZE_LIMITS"] = CONFIG["media_size_limits"]
+app.config["UPLOAD_DEFAULT_SIZE_LIMIT"] = min(CONFIG["media_size_limits"].values())
+# room for the message and the multipart framing around the largest file
+app.config["MAX_CONTENT_LENGTH"] = max(CONFIG["media_size_limits"].values()) + 1024 * 1024
+
+db.get_pool(CONFIG["database"], CONFIG["database_pool_size"])
+db.get_writer(CONFIG["database"], CONFIG["write_batch_latency"])
+
+session_cache = TTLCache(CONFIG["session_cache_size"], CONFIG["session_cache_ttl"])
+
+password_hasher = PasswordHasher(CONFIG["password_hash_workers"], CONFIG["password_hash_queue"],
+                                 CONFIG["password_hash_method"])
 
 
 class ApiError(Exception):
@@ -66,18 +140,27 @@ class Session(object):
             db.persist_session(self.user.email, self.token)
         except db.CouldNotCreateSessionError:
             raise ApiError("Could not create session.")
+        publish_session_change(self.user.email, self.token)
 
     def close(self):
         db.delete_session(self.token)
+        publish_session_change(self.user.email)
 
     @staticmethod
     def find_session(token):
+        user = session_cache.get(token)
+        if user is not None:
+            return Session(user, token)
+
         try:
             user_email = db.select_session(token)
-            return Session(User.find_user(user_email), token)
+            user = User.find_user(user_email)
         except (db.SessionDoesNotExistError, db.UserDoesNotExist, UserNotValidError):
             raise SessionNotValidError()
 
+        session_cache.set(token, user, tag=user.email)
+        return Session(user, token)
+
     @staticmethod
     def does_session_exist(token):
         try:
@@ -96,16 +179,23 @@ class Session(object):
 
 
 class Post(object):
-    def __init__(self, to_user, from_user, content, media, date_posted):
+    __slots__ = ("id", "to_user", "from_user", "content", "media", "date_posted")
+
+    def __init__(self, id, to_user, from_user, content, media, date_posted):
+        self.id = id
         self.date_posted = date_posted
         self.content = content
         self.from_user = from_user
         self.to_user = to_user
         self.media = media
 
+    def as_dict(self):
+        return {"id": self.id, "to_user": self.to_user, "from_user": self.from_user, "content": self.content,
+                "media": self.media, "date_posted": self.date_posted}
+
 
 class User(object):
-    def __init__(self, email, password, first_name, family_name, gender, city, country):
+    def __init__(self, email, password, first_name, family_name, gender, city, country, validate=True):
         self.email = email
         self.password = password
         self.first_name = first_name
@@ -113,7 +203,8 @@ class User(object):
         self.gender = gender
         self.city = city
         self.country = country
-        self._validate()
+        if validate:
+            self._validate()
 
     def _validate(self):
         if not (self.email and self.password and self.first_name and self.family_name and
@@ -131,14 +222,28 @@ class User(object):
             raise UserNotValidError("Email is not valid.")
 
     def check_password(self, password):
-        return security.check_password_hash(self.password, password)
+        # the connection goes back to the pool while the hash runs, other requests make better use of it
+        db.close_db()
+        return password_hasher.check(self.password, password)
+
+    def upgrade_password(self, password):
+        """Rehash a verified password if it was hashed with older parameters"""
+        if password_hasher.needs_rehash(self.password):
+            self.password = User.create_password(password)
+            self.persist()
+
+    def get_messages(self, before=None, limit=None):
+        messages = db.select_messages(self.email, before, limit)
+        return [Post(*m) for m in messages]
 
-    def get_messages(self):
-        messages = db.select_messages(self.email)
-        return [Post(**m) for m in messages]
+    def iter_messages(self, before=None):
+        return (Post(*m) for m in db.iter_messages(self.email, before))
+
+    def get_feed(self, before=None, limit=None):
+        return [Post(*m) for m in db.select_feed(self.email, before, limit)]
 
     def get_number_of_messages(self):
-        return len(self.get_messages())
+        return db.select_number_of_messages(self.email)
 
     def post_message(self, to_user_email, message, media_file):
         if not (to_user_email and (message or media_file)):
@@ -157,12 +262,13 @@ class User(object):
                 media = m.name
 
             db.insert_message(to_user_email, self.email, message=message, media=media)
-        except CouldNotPostMediaError, db.CouldNotInsertMessage:
+        except (CouldNotPostMediaError, db.CouldNotInsertMessage):
             raise CouldNotPostMessageError(COULD_NOT_POST_MESSAGE)
 
     def persist(self):
         if not db.persist_user(self.__dict__):
             raise Exception("User could not be persisted???")
+        publish_user_change(self.email)
 
     def get_number_views(self):
         return db.select_page_views(self.email)
@@ -188,13 +294,24 @@ class User(object):
     def find_user(email):
         try:
             user_data = db.select_user(email)
-            return User(**user_data)
+            return User(validate=False, **user_data)
+        except db.UserDoesNotExist:
+            raise UserNotValidError()
+
+    @staticmethod
+    def find_user_info(email):
+        """
+        Public profile of a user, read without building the user
+        """
+        try:
+            return db.select_user_info(email)
         except db.UserDoesNotExist:
             raise UserNotValidError()
 
     @staticmethod
     def create_password(password):
-        return security.generate_password_hash(password)
+        db.close_db()
+        return password_hasher.generate(password)
 
 
 def is_password_valid(password):
@@ -218,20 +335,62 @@ class CouldNotPostMediaError(Exception):
 
 
 class Media:
-    def __init__(self, user, name=None, date_posted=None):
+    def __init__(self, user, name=None, content_hash=None):
         self.name = name or str(uuid.uuid4())
-        self.user = User.find_user(user).email
+        self.user = user
+        self.content_hash = content_hash
 
     def post_media(self, to_persist):
         if not Media._allowed_media(to_persist.filename):
             raise CouldNotPostMediaError()
 
-        self.name = self.name + "." + Media._extract_extension(to_persist.filename)
+        extension = Media._extract_extension(to_persist.filename)
+        self.name = self.name + "." + extension
+        upload = spool(to_persist)
         try:
-            db.insert_media(self.user, self.name)
-            to_persist.save(os.path.join(MEDIA_FOLDER, self.name))
-        except db.CouldNotInsertMedia:
+            # identical uploads share a single file, only the media row is new
+            self.content_hash = upload.hexdigest()
+            stored = upload.store(blob_path(self.content_hash))
+            db.insert_media(self.user, self.name, self.content_hash)
+        except (db.CouldNotInsertMedia, IOError, OSError):
             raise CouldNotPostMediaError()
+        finally:
+            upload.close()
+
+        if stored and not variant_queue.submit(self.content_hash, extension):
+            print("Variant queue is full, {} is only available in original size".format(self.name))
+
+    def path(self):
+        if self.content_hash:
+            blob = blob_path(self.content_hash)
+            # media uploaded before the content addressed store are kept under their name
+            if os.path.exists(blob):
+                return blob
+        return os.path.join(app.root_path, MEDIA_FOLDER, self.name)
+
+    def find_variant(self, size):
+        """
+        :return: (path, content_hash, mimetype) of a variant of this media, None if it does not exist (yet)
+        """
+        variant = db.select_media_variant(self.content_hash, size) if self.content_hash else None
+        if variant is None:
+            return None
+
+        variant_hash, mimetype = variant
+        return blob_path(variant_hash), variant_hash, mimetype
+
+    @staticmethod
+    def create_variants(content_hash, extension):
+        with app.app_context():
+            db.connect_db(CONFIG["database"])
+            existing = db.select_media_variant_sizes(content_hash)
+            for size, _, render in variants_of(extension):
+                if size in existing:
+                    continue
+                staged, mimetype = render_variant(render, blob_path(content_hash), staging_folder())
+                variant_hash = hash_file(staged)
+                store_file(staged, blob_path(variant_hash))
+                db.insert_media_variant(content_hash, size, variant_hash, mimetype)
 
     @staticmethod
     def _allowed_media(filename):
@@ -250,6 +409,9 @@ class Media:
             raise CouldNotFindMediaError()
 
 
+variant_queue = VariantQueue(Media.create_variants, CONFIG["media_variant_workers"], CONFIG["media_variant_queue"])
+
+
 def identify_session():
     try:
         token = request.headers[SESSION_TOKEN]
@@ -260,15 +422,76 @@ def identify_session():
 
 def create_response(status_code, message, data):
     content = {"status_code": status_code, "message": message, "data": data}
-    response = json.jsonify(content)
-    response.status_code = status_code
+    if not CONFIG["compact_json"]:
+        response = json.jsonify(content)
+        response.status_code = status_code
+        return response
 
-    return response
+    # without indentation nor sorted keys the C accelerated encoder of the json module is used
+    return Response(json.dumps(content, separators=(",", ":"), sort_keys=False), status_code,
+                    mimetype="application/json")
+
+
+# routes answered from files or memory, they never query the database
+STATIC_ENDPOINTS = {"static", "main", "static_dist", "static_templates", "static_js", "static_css", "static_images",
+                    "static_bower"}
 
 
 @app.before_request
 def before_request():
-    db.connect_db(CONFIG["database"])
+    if request.endpoint not in STATIC_ENDPOINTS:
+        db.connect_db(CONFIG["database"])
+
+
+def _start_request_timer():
+    request.environ["twidder.started"] = time.time()
+
+
+def _record_request_duration(response):
+    started = request.environ.get("twidder.started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.HTTP_REQUEST_DURATION.observe(time.time() - started, route, request.method,
+                                              str(response.status_code))
+    return response
+
+
+# the hooks are only installed when metrics are enabled, otherwise requests do not pay for them
+if metrics.enabled:
+    # first, so the wait for a database connection is part of the request duration
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request_timer)
+    app.after_request(_record_request_duration)
+
+
+profiler = SamplingProfiler(CONFIG["profile_interval"], CONFIG["profile_directory"])
+
+
+def _start_profile():
+    if is_profiling_requested(CONFIG["profile_key"]) or random.random() < CONFIG["profile_sample_rate"]:
+        request.environ["twidder.profiled"] = profiler.start("{} {}".format(request.method, request.path))
+
+
+def _stop_profile(exception):
+    if request.environ.get("twidder.profiled"):
+        profiler.stop()
+
+
+# like metrics, requests only pay for profiling when it can be asked for
+if CONFIG["profile_key"] or CONFIG["profile_sample_rate"]:
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_profile)
+    app.teardown_request(_stop_profile)
+
+
+@app.route("/metrics")
+def get_metrics():
+    if not metrics.enabled or request.remote_addr not in LOCAL_ADDRESSES:
+        return create_response(404, "API endpoint not found.", [])
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.teardown_appcontext
+def teardown_request(exception=None):
+    db.close_db()
 
 
 @app.route("/api/register", methods=["POST"])
@@ -310,6 +533,7 @@ def login():
         user = User.find_user(auth.username)
         if not user.check_password(auth.password):
             raise CouldNotLoginError()
+        user.upgrade_password(auth.password)
 
         session = Session(user)
         session.persist()
@@ -366,12 +590,12 @@ def get_user_data_by_token():
 @validate_request
 def get_user_data_by_email(email):
     identify_session()
-    other_user = User.find_user(email)
+    user_info = User.find_user_info(email)
 
-    other_user.update_number_views()
-    send_statistics()
+    db.persist_page_views(user_info["email"])
+    publish_statistics(user_info["email"])
 
-    return create_response(200, "Data successfully retrieved.", _create_user_info(other_user))
+    return create_response(200, "Data successfully retrieved.", user_info)
 
 
 def _create_user_info(user):
@@ -383,8 +607,9 @@ def _create_user_info(user):
 @validate_request
 def get_user_messages_by_token():
     user = identify_session().user
-    messages = [m.__dict__ for m in user.get_messages()]
-    return create_response(200, "Messages successfully retrieved.", messages)
+    if request.args.get("stream") == "1":
+        return _stream_messages(user)
+    return create_response(200, MESSAGES_RETRIEVED, _get_messages_page(user.get_messages))
 
 
 @validate_request
@@ -392,21 +617,139 @@ def get_user_messages_by_token():
 def get_user_messages_by_email(email):
     identify_session()
     other_user = User.find_user(email)
+    if request.args.get("stream") == "1":
+        return _stream_messages(other_user)
+    return create_response(200, MESSAGES_RETRIEVED, _get_messages_page(other_user.get_messages))
+
+
+@app.route("/api/feed", methods=["GET"])
+@validate_request
+def get_feed():
+    user = identify_session().user
+    return create_response(200, MESSAGES_RETRIEVED, _get_messages_page(user.get_feed))
+
+
+def _get_messages_page(read_messages):
+    before = _decode_cursor(request.args.get("before"))
+    try:
+        limit = min(int(request.args.get("limit", db.MESSAGES_PAGE_SIZE)), CONFIG["max_messages_page_size"])
+    except ValueError:
+        abort(400)
+    if limit <= 0:
+        abort(400)
+
+    posts = read_messages(before, limit + 1)
+    next_cursor = _encode_cursor(posts[limit - 1]) if len(posts) > limit else None
+
+    return {"messages": [m.as_dict() for m in posts[:limit]], "next": next_cursor}
+
+
+def _stream_messages(user):
+    """
+    Whole wall (from the "before" cursor) in the envelope of a page, written while the posts are read
+    from the database so memory use does not grow with the wall
+    """
+    posts = user.iter_messages(_decode_cursor(request.args.get("before")))
+    head = json.dumps({"status_code": 200, "message": MESSAGES_RETRIEVED}, separators=(",", ":"))
+
+    def generate():
+        # the first bytes leave before the query runs
+        yield head[:-1] + ',"data":{"messages":['
+        separator, chunk = "", []
+        for post in posts:
+            chunk.append(json.dumps(post.as_dict(), separators=(",", ":"), sort_keys=False))
+            if len(chunk) == STREAM_CHUNK_SIZE:
+                yield separator + ",".join(chunk)
+                separator, chunk = ",", []
+        if chunk:
+            yield separator + ",".join(chunk)
+        yield '],"next":null}}'
+
+    # the request context lives until the last chunk is sent, a connection is only checked out to read a batch
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def _encode_cursor(post):
+    return base64.urlsafe_b64encode("{}|{}".format(post.date_posted, post.id))
+
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return None
+
+    try:
+        date_posted, post_id = base64.urlsafe_b64decode(cursor.encode("ascii")).rsplit("|", 1)
+        return date_posted, int(post_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ApiError("Pagination cursor is not valid.", 400)
+
+
+@app.route("/api/search", methods=["GET"])
+@validate_request
+def search_messages():
+    identify_session()
+    expression = _search_expression(request.args.get("q", ""))
+    if not expression:
+        raise ApiError("Search query is empty.", 400)
+
+    after = _decode_search_cursor(request.args.get("after"))
+    try:
+        limit = min(int(request.args.get("limit", db.SEARCH_PAGE_SIZE)), CONFIG["max_messages_page_size"])
+    except ValueError:
+        abort(400)
+    if limit <= 0:
+        abort(400)
+
+    results = db.search_messages(expression, after, limit + 1)
+    next_cursor = _encode_search_cursor(results[limit - 1]) if len(results) > limit else None
+
+    messages = []
+    for result in results[:limit]:
+        message = Post(*result[:6]).as_dict()
+        message["snippet"] = result[6]
+        messages.append(message)
+    return create_response(200, MESSAGES_RETRIEVED, {"messages": messages, "next": next_cursor})
+
+
+def _search_expression(text):
+    """
+    Every word of the query must appear in a post, the last one may be the start of a word. Words are
+    quoted so that nothing the user types is read as FTS5 syntax.
+    """
+    words = re.findall(r"\w+", text, re.UNICODE)
+    if not words:
+        return None
+    return u" ".join(u'"{}"'.format(word) for word in words) + u"*"
+
+
+def _encode_search_cursor(result):
+    rank, post_id = result[7], result[0]
+    return base64.urlsafe_b64encode("{!r}|{}".format(rank, post_id))
 
-    messages = [m.__dict__ for m in other_user.get_messages()]
-    return create_response(200, "Messages successfully retrieved.", messages)
+
+def _decode_search_cursor(cursor):
+    if not cursor:
+        return None
+
+    try:
+        rank, post_id = base64.urlsafe_b64decode(cursor.encode("ascii")).split("|", 1)
+        return float(rank), int(post_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ApiError("Pagination cursor is not valid.", 400)
 
 
 @app.route("/api/messages/<to_user_email>", methods=["POST"])
 @validate_request
 def post_message(to_user_email):
     user = identify_session().user
+    # not held while the upload streams in, the next query checks a connection out again
+    db.close_db()
 
     message = request.form.get("message", "")
     media = request.files.get("media", None)
 
     user.post_message(to_user_email, escape(message), media)
-    send_statistics()
+    publish_statistics(to_user_email)
     return create_response(200, "Message successfully posted.", [])
 
 
@@ -423,16 +766,75 @@ def api_404(name):
 
 @app.route("/media/<name>")
 def get_user_media(name):
-    return send_from_directory(MEDIA_FOLDER, Media.find_media(name).name)
+    media = Media.find_media(name)
+    if not media.content_hash:
+        return send_from_directory(MEDIA_FOLDER, media.name)
+
+    mimetype = mimetypes.guess_type(media.name)[0]
+    try:
+        size = request.args.get("size")
+        if size:
+            variant = media.find_variant(size)
+            if variant is not None:
+                return send_file_cached(*variant)
+            # a size never created, or the poster of a video, is not worth downloading the whole original for
+            kind = variant_kind(Media._extract_extension(media.name), size)
+            if kind is None or not (mimetype or "").startswith(kind + "/"):
+                raise CouldNotFindMediaError()
+            return send_file_cached(media.path(), media.content_hash, mimetype, VARIANT_PENDING_CACHE_CONTROL)
+
+        return send_file_cached(media.path(), media.content_hash, mimetype)
+    except (IOError, OSError):
+        raise CouldNotFindMediaError()
+
+
+_client_secret = (None, None)
+
+# rendered client pages, keyed by template and secret
+_client_pages = {}
 
 
 def get_client_secret():
-    return base64.standard_b64encode(app.config["SECRET_KEY"].encode("hex"))
+    global _client_secret
+    secret_key = app.config["SECRET_KEY"]
+    if _client_secret[0] != secret_key:
+        _client_secret = (secret_key, base64.standard_b64encode(secret_key.encode("hex")))
+    return _client_secret[1]
+
+
+def render_client():
+    """
+    The client page only changes with the secret and the assets build, it is rendered once and then
+    answered from memory, or with a 304 when the browser already has it
+    """
+    # built by "manage.py build-static", the sources are used until then
+    template = "dist/client.html" if assets.is_built(os.path.join(app.root_path, STATIC_FOLDER)) else "client.html"
+    key = (template, get_client_secret())
+    page = _client_pages.get(key)
+    if page is None:
+        _client_pages.clear()
+        body = render_template(template, client_secret=key[1])
+        page = _client_pages[key] = (body, hashlib.sha256(body.encode("utf-8")).hexdigest())
+
+    body, etag = page
+    response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    # the secret changes when the server restarts, browsers must check the page is still current
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 
 @app.route("/")
 def main():
-    return render_template("client.html", client_secret=get_client_secret())
+    return render_client()
+
+
+@app.route("/dist/<filename>")
+def static_dist(filename):
+    try:
+        return assets.send_asset(os.path.join(app.root_path, STATIC_FOLDER), filename)
+    except (IOError, OSError):
+        abort(404)
 
 
 @app.route("/templates/<filename>")
@@ -482,9 +884,17 @@ def bad_request(error):
     return create_response(400, error.message or "Your request is probably missing data.", [])
 
 
+@app.errorhandler(413)
+def request_too_large(error):
+    return create_response(413, "Media is too large.", [])
+
+
 @app.errorhandler(404)
 def default_dump(error):
-    return render_template("client.html", client_secret=get_client_secret())
+    if request.path.startswith("/api/"):
+        return create_response(404, "API endpoint not found.", [])
+    # any other path is a route of the client application
+    return render_client()
 
 
 @app.errorhandler(CouldNotValidateRequestError)
@@ -523,18 +933,114 @@ def generic_error(error):
     return create_response(error.status_code, error.message, [])
 
 
+@app.errorhandler(db.CouldNotSearchMessages)
+def could_not_search(error):
+    return create_response(500, "Could not search messages.", [])
+
+
 @app.errorhandler(CouldNotFindMediaError)
 def media_error(error):
     return create_response(404, "Could not find media!", [])
 
 
+@app.errorhandler(db.PoolTimeoutError)
+@app.errorhandler(HashingPoolSaturatedError)
+def server_busy(error):
+    return create_response(503, "Server is busy, try again later.", [])
+
+
 connected_socket = {}
 
+metrics.WEBSOCKET_CONNECTIONS.function = lambda: len(connected_socket)
+
+connected_token = {}
+
+
+def _fetch_statistics(emails):
+    with app.app_context():
+        db.connect_db(CONFIG["database"])
+        return db.select_statistics(emails)
+
+
+STATISTICS_CHANNEL = "statistics"
+
+SESSION_CHANNEL = "session"
+
+USER_CHANNEL = "user"
+
+pubsub = create_pubsub(**CONFIG["pubsub"])
+
+broadcaster = StatisticsBroadcaster(connected_socket, _fetch_statistics, CONFIG["statistics_window"],
+                                    count_connected=lambda: presence.count())
+
+presence = Presence(pubsub, connected_socket, broadcaster.mark_all_dirty, CONFIG["presence_interval"])
+
+
+def publish_statistics(*emails):
+    pubsub.publish(STATISTICS_CHANNEL, {"users": emails})
+
+
+def publish_session_change(email, valid_token=None):
+    """
+    Close the sockets of a user that are not authenticated with its current session
+    :param email: User whose session changed
+    :param valid_token: Token still valid, None if the user has no session anymore
+    :return:
+    """
+    pubsub.publish(SESSION_CHANNEL, {"user": email, "valid_token": valid_token})
+
+
+def publish_user_change(email):
+    pubsub.publish(USER_CHANNEL, {"user": email})
+
+
+def _on_user_change(message):
+    session_cache.invalidate_tag(message["user"])
+
+
+def _on_statistics(message):
+    broadcaster.mark_dirty(*message["users"])
+
+
+def _on_session_change(message):
+    email = message["user"]
+    session_cache.invalidate_tag(email)
+    if email not in connected_socket or connected_token.get(email) == message["valid_token"]:
+        return
+
+    ws = connected_socket.pop(email)
+    connected_token.pop(email, None)
+    broadcaster.forget(email)
+    ws.close()
+    presence.announce()
+
+
+_started = False
+
+
+def start():
+    """
+    Open the database, applying pending migrations, and listen to the other workers. Importing the application
+    does neither, so that manage.py can use its modules. Called by server.py when a worker starts, and before
+    the first request otherwise.
+    """
+    global _started
+    if _started:
+        return
+    _started = True
+
+    db.init_database(CONFIG["database"], CONFIG["database_schema"])
+    pubsub.subscribe(STATISTICS_CHANNEL, _on_statistics)
+    pubsub.subscribe(SESSION_CHANNEL, _on_session_change)
+    pubsub.subscribe(USER_CHANNEL, _on_user_change)
+
+
+app.before_first_request(start)
+
 
 @sockets.route("/messages")
 def ws_messages(ws):
-    before_request()
-
+    metrics.WEBSOCKET_OPENED.inc()
     try:
         _websocket_connection(ws)
     except WebSocketError as e:
@@ -542,11 +1048,8 @@ def ws_messages(ws):
 
 
 def _websocket_connection(ws):
-    token = None
+    user = None
     while not ws.closed:
-        if token and not Session.does_session_exist(token):
-            ws.close()
-
         message = None
         try:
             message = ws.receive()
@@ -560,26 +1063,47 @@ def _websocket_connection(ws):
         content_type = content["type"]
 
         if content_type == "authenticate":
-            token = content["data"]
-            if not _authenticate_user(token, ws):
+            user = _authenticate_user(content["data"], ws)
+            if not user:
                 ws.close()
-            send_statistics()
+            else:
+                broadcaster.request(user.email)
+            presence.announce()
         if content_type == "statistics":
-            send_statistics()
+            if user:
+                broadcaster.request(user.email)
         else:
             pass
 
-    pop_user(token)
-    send_statistics()
+    if user and connected_socket.get(user.email) is ws:
+        connected_socket.pop(user.email)
+        connected_token.pop(user.email, None)
+        broadcaster.forget(user.email)
+    presence.announce()
+
+
+def close_websockets():
+    """Called by a stopping worker, the clients reconnect to another one"""
+    for ws in connected_socket.values():
+        try:
+            ws.close()
+        except WebSocketError:
+            pass
 
 
 def _authenticate_user(token, ws):
-    user = pop_user(token)
+    # not before_request, /messages matches the static route of the application
+    db.connect_db(CONFIG["database"])
+    try:
+        user = pop_user(token)
+    finally:
+        db.close_db()
     if not user:
         return False
 
-    connected_socket[user] = ws
-    return True
+    connected_socket[user.email] = ws
+    connected_token[user.email] = token
+    return user
 
 
 def pop_user(token):
@@ -587,16 +1111,5 @@ def pop_user(token):
     if not user:
         return False
 
-    connected_socket.pop(user).close() if user in connected_socket else None
+    publish_session_change(user.email)
     return user
-
-
-def send_statistics():
-    statistic = {
-        "nb_connected_users": len(connected_socket)
-    }
-
-    for k in connected_socket:
-        statistic["nb_posts"] = k.get_number_of_messages()
-        statistic["nb_views"] = k.get_number_views()
-        connected_socket[k].send(json.dumps({"type": "statistics", "data": statistic}))
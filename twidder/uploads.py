@@ -0,0 +1,152 @@
+import os
+import errno
+import hashlib
+import tempfile
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+CHUNK_SIZE = 64 * 1024
+
+STAGING_FOLDER = "staging"
+
+BLOBS_FOLDER = "blobs"
+
+
+class HashingUpload(object):
+    def __init__(self, directory, max_size=None):
+        """
+        Uploaded file written to a staging file on disk and hashed while it streams in
+        :param directory: Staging directory, must be on the same filesystem as the blob store
+        :param max_size: Bytes accepted before the upload is refused, None for no limit
+        :return:
+        """
+        _make_directory(directory)
+        fd, self.name = tempfile.mkstemp(prefix="upload-", dir=directory)
+        self.size = 0
+        self.max_size = max_size
+        self._file = os.fdopen(fd, "w+b")
+        self._hash = hashlib.sha256()
+        self._stored = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge()
+        self._hash.update(data)
+        self._file.write(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def store(self, path):
+        """
+        Move the upload to its final path, unless identical content is already stored there
+        :param path: Content addressed path of the upload
+        :return: True if the content was not stored yet
+        """
+        self._file.close()
+        self._stored = True
+        return store_file(self.name, path)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if not self._stored:
+            self._stored = True
+            os.remove(self.name)
+
+
+class UploadRequest(Request):
+    """
+    Streams uploaded files to disk instead of memory, the UPLOAD_SIZE_LIMITS config maps a
+    file extension to the size accepted for it (UPLOAD_DEFAULT_SIZE_LIMIT for the others)
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = HashingUpload(staging_folder(), upload_size_limit(filename))
+        # kept here as well, an upload refused halfway never reaches request.files
+        self.__dict__.setdefault("uploads", []).append(upload)
+        return upload
+
+    def close(self):
+        try:
+            super(UploadRequest, self).close()
+        finally:
+            for upload in self.__dict__.pop("uploads", ()):
+                upload.close()
+
+
+def staging_folder():
+    return os.path.join(current_app.root_path, current_app.config["UPLOAD_FOLDER"], STAGING_FOLDER)
+
+
+def blob_path(content_hash):
+    return os.path.join(current_app.root_path, current_app.config["UPLOAD_FOLDER"], BLOBS_FOLDER,
+                        content_hash[:2], content_hash)
+
+
+def upload_size_limit(filename):
+    extension = filename.rsplit(".", 1)[-1].lower() if filename and "." in filename else None
+    return current_app.config.get("UPLOAD_SIZE_LIMITS", {}).get(
+        extension, current_app.config.get("UPLOAD_DEFAULT_SIZE_LIMIT"))
+
+
+def spool(file_storage):
+    """
+    :param file_storage: Uploaded file
+    :return: The upload as a HashingUpload, copying it if it was not streamed by UploadRequest
+    """
+    if isinstance(file_storage.stream, HashingUpload):
+        return file_storage.stream
+
+    upload = HashingUpload(staging_folder(), upload_size_limit(file_storage.filename))
+    try:
+        for chunk in iter(lambda: file_storage.stream.read(CHUNK_SIZE), b""):
+            upload.write(chunk)
+    except:
+        upload.close()
+        raise
+    return upload
+
+
+def store_file(staged, path):
+    """
+    Move a staged file to its content addressed path, dropping it if that content is already stored
+    :return: True if the content was not stored yet
+    """
+    if os.path.exists(path):
+        os.remove(staged)
+        return False
+
+    _make_directory(os.path.dirname(path))
+    os.rename(staged, path)
+    return True
+
+
+def hash_file(path):
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def _make_directory(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,163 @@
+import os
+import tempfile
+from distutils.spawn import find_executable
+
+import gevent
+import gevent.queue
+import gevent.subprocess
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+FFMPEG = find_executable("ffmpeg")
+
+DEFAULT_WORKERS = 2
+
+DEFAULT_QUEUE_SIZE = 256
+
+# (size, longest side in pixels) of the image variants
+IMAGE_SIZES = (("thumb", 320), ("medium", 800))
+
+JPEG_QUALITY = 80
+
+
+class VariantQueue(object):
+    def __init__(self, create_variants, workers=DEFAULT_WORKERS, max_pending=DEFAULT_QUEUE_SIZE):
+        """
+        Jobs creating media variants in background greenlets, so posting a media does not wait for them
+        :param create_variants: Called with the arguments of each submitted job
+        :param workers: Number of jobs run concurrently
+        :param max_pending: Jobs waiting before new ones are dropped, their media are served in original size
+        :return:
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self._create_variants = create_variants
+        self._pid = None
+        self._jobs = None
+        self._greenlets = []
+
+    def submit(self, *job):
+        """
+        :return: False if the queue is full and the job was dropped
+        """
+        self._ensure_started()
+        try:
+            self._jobs.put_nowait(job)
+            return True
+        except gevent.queue.Full:
+            return False
+
+    def join(self):
+        """Wait until every submitted job is done"""
+        if self._jobs is not None:
+            self._jobs.join()
+
+    def close(self):
+        gevent.killall(self._greenlets)
+        self._greenlets = []
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            # greenlets are not inherited by forked workers
+            self._pid = os.getpid()
+            self._jobs = gevent.queue.JoinableQueue(self.max_pending)
+            self._greenlets = []
+
+        self._greenlets = [greenlet for greenlet in self._greenlets if not greenlet.dead]
+        while len(self._greenlets) < self.workers:
+            self._greenlets.append(gevent.spawn(self._work))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                self._create_variants(*job)
+            except Exception as e:
+                print("Could not create media variants: {}".format(e))
+            finally:
+                self._jobs.task_done()
+
+
+def variants_of(extension):
+    """
+    Variants this server can create, images need PIL and videos or audio need ffmpeg
+    :param extension: Extension of the original media
+    :return: [(size, kind, render)], kind is the media type of the variant ("image", "video" or "audio"),
+    render(source, destination) writes the variant and returns its mimetype
+    """
+    variants = []
+    if extension in ("jpg", "png") and Image is not None:
+        variants.extend((size, "image", _image_resizer(longest_side)) for size, longest_side in IMAGE_SIZES)
+
+    if FFMPEG is not None:
+        if extension == "mp4":
+            variants.append(("thumb", "image", _ffmpeg_transcoder("image/jpeg", (
+                "-vf", "thumbnail,scale='min(320,iw)':-2", "-frames:v", "1", "-f", "mjpeg"))))
+            variants.append(("web", "video", _ffmpeg_transcoder("video/mp4", (
+                "-vf", "scale='min(1280,iw)':-2", "-c:v", "libx264", "-preset", "veryfast", "-crf", "26",
+                "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart", "-f", "mp4"))))
+        elif extension == "wav":
+            variants.append(("web", "audio", _ffmpeg_transcoder("audio/mpeg", (
+                "-c:a", "libmp3lame", "-b:a", "128k", "-f", "mp3"))))
+
+    return variants
+
+
+def variant_kind(extension, size):
+    """
+    :return: Media type of the size variant of a media, None if this server never creates it
+    """
+    for variant_size, kind, _ in variants_of(extension):
+        if variant_size == size:
+            return kind
+    return None
+
+
+def render_variant(render, source, directory):
+    """
+    :param render: Render function returned by variants_of
+    :param source: Original media
+    :param directory: Staging directory the variant is written to
+    :return: (staged path, mimetype) of the variant
+    """
+    fd, staged = tempfile.mkstemp(prefix="variant-", dir=directory)
+    os.close(fd)
+    try:
+        return staged, render(source, staged)
+    except:
+        os.remove(staged)
+        raise
+
+
+def _image_resizer(longest_side):
+    def render(source, destination):
+        # decoding and resampling hold the CPU, a native thread keeps the hub serving requests
+        return _in_thread(_resize_image, source, destination, longest_side)
+    return render
+
+
+def _resize_image(source, destination, longest_side):
+    image = Image.open(source)
+    image.thumbnail((longest_side, longest_side), Image.ANTIALIAS)
+    if image.mode in ("RGBA", "LA", "P"):
+        image.save(destination, "PNG", optimize=True)
+        return "image/png"
+
+    image.convert("RGB").save(destination, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return "image/jpeg"
+
+
+def _ffmpeg_transcoder(mimetype, options):
+    def render(source, destination):
+        command = (FFMPEG, "-nostdin", "-loglevel", "error", "-y", "-i", source) + options + (destination,)
+        gevent.subprocess.check_call(command)
+        return mimetype
+    return render
+
+
+def _in_thread(function, *args):
+    # at most one per variant worker, the threadpool of the hub is shared with the rest of the process
+    return gevent.get_hub().threadpool.apply(function, args)